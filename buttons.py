@@ -34,11 +34,17 @@ class Buttons:
 
     def get_dest_file(self):
             if self.mount():
-                newest = max(glob.iglob('/mnt/*.[Ss][Vv][Gg]'), key=os.path.getctime)
-                if newest=="":
+                # Sliced SVGs or pre-rendered layer archives
+                parts = glob.glob('/mnt/*.[Ss][Vv][Gg]') + glob.glob('/mnt/*.[Zz][Ii][Pp]')
+                if not parts:
                     return False
+                newest = max(parts, key=os.path.getctime)
                 print "Parece que ha encontrado nuevo: " + newest
-                shutil.copy(newest,'/root/part.svg')
+                ext = os.path.splitext(newest)[1].lower()
+                for old in ('/root/part.svg', '/root/part.zip'):
+                    if os.path.exists(old):
+                        os.remove(old)
+                shutil.copy(newest,'/root/part' + ext)
                 config="/mnt/config.txt"
                 print "Copiando config"
                 shutil.copy(config,'/root/.pronsolerc')
@@ -76,7 +82,7 @@ class Buttons:
                 if not self.get_dest_file():
                     self.estado = 0
                     self.umount()
-                    self.l.put_lines("Introduzca USB","con .svg valido")
+                    self.l.put_lines("Introduzca USB","con .svg o .zip")
                     return
                 call(["/usr/bin/python", "/root/Resinrun_2/pronterface.py","-c","/root/.pronsolerc"])
                 print "Terminado"
@@ -0,0 +1,129 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import mmap
+import fcntl
+import struct
+import numpy
+
+# linux/fb.h
+FBIOGET_VSCREENINFO = 0x4600
+FBIOGET_FSCREENINFO = 0x4602
+# xres, yres, xres_virtual, yres_virtual, xoffset, yoffset, bits_per_pixel,
+# grayscale, then offset, length, msb_right of red, green, blue, transp
+VSCREENINFO = struct.Struct("=8I12I")
+# id, smem_start, smem_len, type, type_aux, visual, xpanstep, ypanstep,
+# ywrapstep, line_length
+FSCREENINFO = struct.Struct("@16sL4I3HI")
+
+class DisplayBackend(object):
+    """Where composed projector frames end up.
+
+    show(frame) puts a raster.FrameBuffer on the projector. With changed
+    False the frame is the one shown last and only has to be made visible
+    again. blank() turns the projector black. Backends with gui set must
+    be called from the wx thread."""
+
+    gui = False
+
+    def show(self, frame, changed=True):
+        raise NotImplementedError
+
+    def blank(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class FramebufferBackend(DisplayBackend):
+    """Writes frames straight into an mmap of a Linux framebuffer device,
+    with no window system involved.
+
+    Each frame is converted to the device pixel format in a page-aligned
+    staging buffer and then copied to the screen in one go, so the
+    projector never shows a half written layer. path can also be a plain
+    file, in which case size (and optionally bpp) give the screen layout;
+    the file is grown to fit a frame."""
+
+    def __init__(self, path="/dev/fb0", size=None, bpp=32):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR)
+        try:
+            try:
+                self._query()
+            except IOError:
+                # Not a framebuffer device
+                if size is None:
+                    raise ValueError("%s is not a framebuffer, a size is needed" % path)
+                self._plain(size, bpp)
+            self.length = self.stride * self.height
+            self.map = mmap.mmap(self.fd, self.length, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        except:
+            os.close(self.fd)
+            raise
+        self.screen = numpy.frombuffer(self.map, numpy.uint8, self.length)
+        # Anonymous maps start on a page boundary
+        self.staging_map = mmap.mmap(-1, self.length)
+        self.staging = numpy.frombuffer(self.staging_map, numpy.uint8, self.length)
+        self.rows = self.staging.reshape(self.height, self.stride)
+
+    def _query(self):
+        var = VSCREENINFO.unpack(fcntl.ioctl(self.fd, FBIOGET_VSCREENINFO, "\0" * 160)[:VSCREENINFO.size])
+        fix = FSCREENINFO.unpack(fcntl.ioctl(self.fd, FBIOGET_FSCREENINFO, "\0" * 80)[:FSCREENINFO.size])
+        self.width, self.height, self.bpp = var[0], var[1], var[6]
+        self.offsets = (var[8], var[11], var[14])
+        self.stride = fix[-1]
+
+    def _plain(self, size, bpp):
+        self.width, self.height = int(size[0]), int(size[1])
+        self.bpp = bpp
+        # XRGB, or RGB565 for 16 bits
+        self.offsets = (11, 5, 0) if bpp == 16 else (16, 8, 0)
+        self.stride = self.width * bpp // 8
+        if os.fstat(self.fd).st_size < self.stride * self.height:
+            os.ftruncate(self.fd, self.stride * self.height)
+
+    def _convert(self, frame):
+        h = min(frame.height, self.height)
+        w = min(frame.width, self.width)
+        pixels = frame.pixels[:h, :w]
+        self.staging.fill(0)
+        if self.bpp == 16:
+            out = self.rows[:h, :w * 2].view(numpy.uint16)
+            red, green, blue = [pixels[:, :, c].astype(numpy.uint16) for c in range(3)]
+            out[:] = ((red >> 3) << self.offsets[0]) | ((green >> 2) << self.offsets[1]) | ((blue >> 3) << self.offsets[2])
+        elif self.bpp in (24, 32):
+            out = self.rows[:h, :w * self.bpp // 8].reshape(h, w, self.bpp // 8)
+            for channel, offset in enumerate(self.offsets):
+                out[:, :, offset // 8] = pixels[:, :, channel]
+        else:
+            raise ValueError("Unsupported framebuffer depth %d" % self.bpp)
+
+    def show(self, frame, changed=True):
+        if changed:
+            self._convert(frame)
+        self.screen[:] = self.staging
+
+    def blank(self):
+        self.screen.fill(0)
+
+    def close(self):
+        if self.map is not None:
+            self.blank()
+            self.map.close()
+            self.staging_map.close()
+            os.close(self.fd)
+            self.map = None
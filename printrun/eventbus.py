@@ -0,0 +1,216 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import traceback
+from threading import Thread, Lock, Condition
+from collections import deque
+
+from printrun.printrun_utils import install_locale
+install_locale('pronterface')
+
+# What a subscriber whose queue is full loses: the oldest event queued, or
+# everything but the latest one
+DROP_OLDEST = "drop-oldest"
+COALESCE = "coalesce"
+
+class Subscription(object):
+    """A function subscribed to an event, with the queue of calls it has
+    not had yet. dropped counts the events it lost to its policy."""
+
+    def __init__(self, bus, event, fn, policy, maxlen):
+        self.bus = bus
+        self.event = event
+        # What the event is called in log messages
+        self.name = event
+        self.fn = fn
+        self.policy = policy
+        self.queue = deque(maxlen = 1 if policy == COALESCE else maxlen)
+        self.dropped = 0
+        self.scheduled = False
+        self.active = True
+
+    def cancel(self):
+        self.bus.unsubscribe(self)
+
+class EventBus(object):
+    """Hands events to their subscribers from a thread of its own, so the
+    thread publishing them never waits on a subscriber.
+
+    Every subscriber has a bounded queue. When it falls behind, a
+    DROP_OLDEST subscriber loses its oldest events and a COALESCE one only
+    gets the latest. Subscribers are called one event at a time, in turn,
+    each in the order its events were published."""
+
+    def __init__(self, name = "events"):
+        self.name = name
+        # event -> tuple of Subscriptions, replaced rather than changed so
+        # publish can look it up without locking
+        self.subscribers = {}
+        self.lock = Lock()
+        self.cv = Condition(self.lock)
+        self.ready = deque()
+        self.busy = False
+        self.running = False
+        self.thread = None
+        # Functions passed to call(), which are never dropped
+        self.calls = Subscription(self, "call", run_call, DROP_OLDEST, None)
+
+    def _start(self):
+        # Started on first use, most buses never get a subscriber
+        if self.thread is None:
+            self.running = True
+            self.thread = Thread(target = self._run, name = self.name)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def subscribe(self, event, fn, policy = DROP_OLDEST, maxlen = 1024):
+        if policy not in (DROP_OLDEST, COALESCE):
+            raise ValueError(_("Unknown event policy: %s") % policy)
+        subscription = Subscription(self, event, fn, policy, maxlen)
+        with self.lock:
+            self.subscribers[event] = self.subscribers.get(event, ()) + (subscription,)
+            self._start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscription.active = False
+            subscription.queue.clear()
+            rest = tuple(s for s in self.subscribers.get(subscription.event, ())
+                         if s is not subscription)
+            if rest:
+                self.subscribers[subscription.event] = rest
+            else:
+                self.subscribers.pop(subscription.event, None)
+
+    def subscribed(self, event):
+        return event in self.subscribers
+
+    def publish(self, event, *args):
+        subscribers = self.subscribers.get(event)
+        if not subscribers:
+            return
+        with self.lock:
+            for subscription in subscribers:
+                self._queue(subscription, args)
+            self.cv.notify_all()
+
+    def call(self, fn, *args):
+        """Call fn(*args) from the bus thread, in turn with the events, for
+        a one-off callback that has no event of its own"""
+        with self.lock:
+            self._start()
+            self._queue(self.calls, (fn, args))
+            self.cv.notify_all()
+
+    def _queue(self, subscription, args):
+        queue = subscription.queue
+        if len(queue) == queue.maxlen:
+            subscription.dropped += 1
+        queue.append(args)
+        if not subscription.scheduled:
+            subscription.scheduled = True
+            self.ready.append(subscription)
+
+    def wait(self):
+        """Block until every event published so far has been handed out"""
+        with self.lock:
+            while self.running and (self.ready or self.busy):
+                self.cv.wait()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.cv.notify_all()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while True:
+            with self.lock:
+                self.busy = False
+                if not self.ready:
+                    # Idle, wake anyone in wait()
+                    self.cv.notify_all()
+                while self.running and not self.ready:
+                    self.cv.wait()
+                if not self.running:
+                    return
+                subscription = self.ready.popleft()
+                args = subscription.queue.popleft() if subscription.queue else None
+                if subscription.queue:
+                    self.ready.append(subscription)
+                else:
+                    subscription.scheduled = False
+                self.busy = True
+            if args is not None and subscription.active:
+                try:
+                    subscription.fn(*args)
+                except:
+                    logging.error(_("Callback for %s failed:") % subscription.name +
+                                  "\n" + traceback.format_exc())
+
+class Channel(object):
+    """The events of one source, such as a printer, on a bus shared with
+    others: subscribe, publish, subscribed, call and wait as on the bus,
+    with event names that only reach this channel's subscribers. Many
+    channels share the one bus thread."""
+
+    def __init__(self, bus, name):
+        self.bus = bus
+        self.name = name
+        # Only tells the channel's events apart, so that a subscription
+        # does not keep the source alive
+        self.key = object()
+
+    def subscribe(self, event, fn, policy = DROP_OLDEST, maxlen = 1024):
+        subscription = self.bus.subscribe((self.key, event), fn, policy, maxlen)
+        subscription.name = "%s %s" % (self.name, event)
+        return subscription
+
+    def subscribed(self, event):
+        return self.bus.subscribed((self.key, event))
+
+    def publish(self, event, *args):
+        self.bus.publish((self.key, event), *args)
+
+    def call(self, fn, *args):
+        self.bus.call(fn, *args)
+
+    def wait(self):
+        self.bus.wait()
+
+def run_call(fn, args):
+    fn(*args)
+
+def callback(event, policy = DROP_OLDEST, maxlen = 1024):
+    """A property for a callback attribute such as recvcb: the function
+    assigned to it is subscribed to event on the object's events bus or
+    Channel, so it is called from the bus thread rather than the one
+    publishing"""
+    attr = "_%s_subscription" % event
+
+    def get(self):
+        subscription = getattr(self, attr, None)
+        return subscription.fn if subscription else None
+
+    def set(self, fn):
+        subscription = getattr(self, attr, None)
+        if subscription:
+            subscription.cancel()
+        setattr(self, attr, self.events.subscribe(event, fn, policy, maxlen) if fn else None)
+    return property(get, set)
@@ -0,0 +1,243 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import errno
+import fcntl
+import heapq
+import select
+import logging
+import traceback
+from itertools import count
+from threading import Thread, Lock, current_thread
+from collections import deque
+
+from printrun.eventbus import EventBus
+from printrun.printrun_utils import install_locale, monotonic
+install_locale('pronterface')
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class LineSplitter(object):
+    """Collects bytes read from a stream and hands back whole lines, each
+    with its newline, as readline() would"""
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf += data
+        end = self.buf.rfind("\n")
+        if end < 0:
+            return []
+        lines = str(self.buf[:end]).split("\n")
+        del self.buf[:end + 1]
+        return [line + "\n" for line in lines]
+
+    def clear(self):
+        del self.buf[:]
+
+class Timer(object):
+    """Returned by EventLoop.call_later, cancel() keeps it from running"""
+
+    __slots__ = ('when', 'fn', 'args', 'cancelled')
+
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop(object):
+    """Runs callbacks for file descriptors and timers from a single thread,
+    sleeping in poll() in between, so any number of printers can be driven
+    without a thread each and without polling.
+
+    Callbacks run on the loop thread and must not block. call_soon and
+    call_later may be used from any thread; the other methods are meant for
+    the loop thread, and called from elsewhere are passed to it."""
+
+    def __init__(self):
+        self.poller = select.poll()
+        self.readers = {}
+        self.writers = {}
+        self.timers = []
+        self.sequence = count()
+        self.ready = deque()
+        self.thread = None
+        self.running = False
+        # Writing to the pipe wakes the loop up from other threads
+        self.wake_fd, self.waker = os.pipe()
+        set_nonblocking(self.wake_fd)
+        set_nonblocking(self.waker)
+        self.poller.register(self.wake_fd, select.POLLIN)
+        self.lock = Lock()
+        # Hands out the events of everything driven by this loop, from one
+        # thread however many printers there are
+        self.events = EventBus("event-loop-events")
+
+    def in_loop(self):
+        return current_thread() is self.thread
+
+    def _wake(self):
+        if not self.in_loop():
+            try:
+                os.write(self.waker, "x")
+            except OSError as e:
+                # Already full, it will wake up anyway
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def call_soon(self, fn, *args):
+        self.ready.append((fn, args))
+        self._wake()
+
+    def call_later(self, delay, fn, *args):
+        timer = Timer(monotonic() + delay, fn, args)
+        with self.lock:
+            heapq.heappush(self.timers, (timer.when, next(self.sequence), timer))
+        self._wake()
+        return timer
+
+    def _update(self, fd):
+        mask = 0
+        if fd in self.readers:
+            mask |= select.POLLIN | select.POLLPRI
+        if fd in self.writers:
+            mask |= select.POLLOUT
+        if mask:
+            self.poller.register(fd, mask)
+        else:
+            try:
+                self.poller.unregister(fd)
+            except KeyError:
+                pass
+
+    def add_reader(self, fd, fn, *args):
+        if not self.in_loop() and self.running:
+            return self.call_soon(self.add_reader, fd, fn, *args)
+        self.readers[fd] = (fn, args)
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        if not self.in_loop() and self.running:
+            return self.call_soon(self.remove_reader, fd)
+        self.readers.pop(fd, None)
+        self._update(fd)
+
+    def add_writer(self, fd, fn, *args):
+        if not self.in_loop() and self.running:
+            return self.call_soon(self.add_writer, fd, fn, *args)
+        self.writers[fd] = (fn, args)
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        if not self.in_loop() and self.running:
+            return self.call_soon(self.remove_writer, fd)
+        self.writers.pop(fd, None)
+        self._update(fd)
+
+    def _run_callback(self, fn, args):
+        try:
+            fn(*args)
+        except Exception:
+            logging.error(_("Event loop callback failed:") + "\n" + traceback.format_exc())
+
+    def _timeout(self):
+        """How long poll() may sleep, in milliseconds, -1 for as long as
+        it takes"""
+        if self.ready:
+            return 0
+        with self.lock:
+            while self.timers and self.timers[0][2].cancelled:
+                heapq.heappop(self.timers)
+            if not self.timers:
+                return -1
+            when = self.timers[0][0]
+        # Rounded up, waking early would spin until the timer is due
+        return max(0, int((when - monotonic()) * 1000) + 1)
+
+    def run_once(self):
+        try:
+            events = self.poller.poll(self._timeout())
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, mask in events:
+            if fd == self.wake_fd:
+                try:
+                    while os.read(self.wake_fd, 4096):
+                        pass
+                except OSError:
+                    pass
+                continue
+            # Errors and hangups go to the reader, whose read reports them
+            if mask & (select.POLLIN | select.POLLPRI | select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                callback = self.readers.get(fd)
+                if callback:
+                    self._run_callback(*callback)
+            if mask & select.POLLOUT:
+                callback = self.writers.get(fd)
+                if callback:
+                    self._run_callback(*callback)
+        now = monotonic()
+        due = []
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                due.append(heapq.heappop(self.timers)[2])
+        for timer in due:
+            if not timer.cancelled:
+                self._run_callback(timer.fn, timer.args)
+        # Only the callbacks queued so far, those queued now run next time
+        for i in xrange(len(self.ready)):
+            self._run_callback(*self.ready.popleft())
+
+    def run(self):
+        self.thread = current_thread()
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def start(self):
+        """Run the loop on a thread of its own"""
+        self.running = True
+        self.thread = Thread(target = self.run, name = "event-loop")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wake()
+        if self.thread and not self.in_loop():
+            self.thread.join()
+
+_default_loop = None
+_default_lock = Lock()
+
+def default_loop():
+    """The loop shared by everything that is not given one, started on
+    first use"""
+    global _default_loop
+    with _default_lock:
+        if _default_loop is None:
+            _default_loop = EventLoop()
+            _default_loop.start()
+        return _default_loop
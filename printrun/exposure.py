@@ -0,0 +1,245 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import logging
+import traceback
+from threading import Thread, Event, Timer, Condition
+
+from printrun.printrun_utils import monotonic
+
+def direct(fn, *args):
+    fn(*args)
+    return monotonic()
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+class ExposureScheduler(object):
+    """Drives the layer cycle of a resin job from its own thread against
+    absolute deadlines on the monotonic clock.
+
+    Every layer goes: exposure on, optional shutter open, exposure off,
+    lift, settle. The job object provides the actions and durations:
+
+        job.prepare(i) -> layer       fetch/render layer i (may block)
+        job.expose(i, layer)          put the layer on screen
+        job.shutter_delay(i)          seconds from on to shutter open, or 0
+        job.open_shutter(i)
+        job.exposure_time(i)          seconds, counted from when light is on
+        job.hide(i)                   blank the screen
+        job.lift_delay(i)             seconds the lift waits after off
+        job.lift(i) -> ack or None    an Ack the lift is done on, or None
+        job.lift_timeout(i)           longest wait for that ack, in seconds
+        job.settle_time(i)            seconds after the lift before next on
+        job.progress(i)               called once layer i is exposing
+        job.finish(completed)
+
+    progress is called from a thread of its own, as updating a status
+    display can take seconds (the I2C LCD does), far longer than an
+    exposure; if it falls behind it is only told of the latest layer.
+
+    expose and hide go through dispatch(fn, *args), which must run fn where
+    it is allowed to touch the display and return the monotonic time it
+    actually ran; the scheduler measures that latency and issues those
+    calls that much early. Exposure length is always timed from the
+    measured on time, and each layer is planned from when the previous
+    lift finished rather than chained off the previous callback, so a
+    late exposure off eats into the lift delay slack instead of pushing
+    the rest of the job back.
+
+    When lift returns an ack (printcore.Ack, for the lift's ok or an M400
+    after it) the settle time counts from when the printer acknowledged
+    it, so a layer only takes as long as the motion does. If the ack does
+    not come within lift_timeout the job carries on from the timeout."""
+
+    # Longest single sleep, so stop() is noticed promptly
+    tick = 0.05
+
+    def __init__(self, job, count, dispatch=direct, start_delay=0.0):
+        self.job = job
+        self.count = count
+        self.dispatch = dispatch
+        self.start_delay = start_delay
+        self.stopped = Event()
+        self.pending = None
+        self.thread = None
+        self.latency = 0.0
+        self.records = []
+        self.completed = False
+        self.progress_cv = Condition()
+        self.progress_index = None
+        self.progress_done = False
+        self.progress_thread = None
+
+    def start(self, first=0):
+        self.stopped.clear()
+        self.progress_index = None
+        self.progress_done = False
+        self.progress_thread = Thread(target=self._progress, name="exposure-progress")
+        self.progress_thread.daemon = True
+        self.progress_thread.start()
+        self.thread = Thread(target=self._run, args=(first,), name="exposure-scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        pending = self.pending
+        if pending is not None:
+            pending.event.set()
+
+    def join(self, timeout=None):
+        if self.thread:
+            self.thread.join(timeout)
+
+    def _wait_until(self, deadline):
+        while not self.stopped.is_set():
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return True
+            time.sleep(min(remaining, self.tick))
+        return False
+
+    def _at(self, deadline, fn, *args):
+        """Run fn directly at deadline, return when it ran"""
+        if not self._wait_until(deadline):
+            return None
+        fn(*args)
+        return monotonic()
+
+    def _wait_ack(self, ack, timeout):
+        """Block until ack arrives, timeout passes or stop() is called.
+        Returns when it arrived, or None"""
+        self.pending = ack
+        # A plain wait() wakes up right away, unlike a wait with a timeout
+        timer = Timer(timeout, ack.event.set)
+        timer.daemon = True
+        timer.start()
+        try:
+            if not self.stopped.is_set():
+                ack.event.wait()
+        finally:
+            timer.cancel()
+            self.pending = None
+        return ack.acked
+
+    def _dispatch_at(self, deadline, fn, *args):
+        """Run fn through dispatch so that it lands at deadline"""
+        if not self._wait_until(deadline - self.latency):
+            return None
+        issued = monotonic()
+        ran = self.dispatch(fn, *args)
+        # Smoothed dispatch latency, used to issue the next call early
+        self.latency = 0.8 * self.latency + 0.2 * max(0.0, ran - issued)
+        return ran
+
+    def _report(self, i):
+        """Hand layer i to the progress thread without waiting for it"""
+        with self.progress_cv:
+            self.progress_index = i
+            self.progress_cv.notify()
+
+    def _progress(self):
+        while True:
+            with self.progress_cv:
+                while self.progress_index is None and not self.progress_done:
+                    self.progress_cv.wait()
+                i = self.progress_index
+                self.progress_index = None
+            if i is None:
+                return
+            try:
+                self.job.progress(i)
+            except Exception:
+                logging.error("Layer %d: progress failed:\n" % i + traceback.format_exc())
+
+    def _end_progress(self):
+        """Let the progress thread report what it has left, then stop it"""
+        with self.progress_cv:
+            self.progress_done = True
+            self.progress_cv.notify()
+        self.progress_thread.join()
+
+    def _run(self, first):
+        job = self.job
+        try:
+            planned_on = monotonic() + self.start_delay
+            for i in xrange(first, self.count):
+                layer = job.prepare(i)
+                if self.stopped.is_set():
+                    break
+                on = self._dispatch_at(planned_on, job.expose, i, layer)
+                if on is None:
+                    break
+                self._report(i)
+                lit = on
+                shutter = job.shutter_delay(i)
+                if shutter:
+                    lit = self._at(on + shutter, job.open_shutter, i)
+                    if lit is None:
+                        break
+                exposure = job.exposure_time(i)
+                off = self._dispatch_at(lit + exposure, job.hide, i)
+                if off is None:
+                    break
+                planned_lift = planned_on + shutter + exposure + job.lift_delay(i)
+                lift_deadline = max(planned_lift, off)
+                if not self._wait_until(lift_deadline):
+                    break
+                ack = job.lift(i)
+                lifted = monotonic()
+                lift_wait = 0.0
+                if ack is not None:
+                    acked = self._wait_ack(ack, job.lift_timeout(i))
+                    if self.stopped.is_set():
+                        break
+                    if acked is None:
+                        logging.warning("Layer %d: no ack for the lift after %.1fs, carrying on" % (i, job.lift_timeout(i)))
+                        acked = monotonic()
+                    lift_wait = max(0.0, acked - lifted)
+                    lifted += lift_wait
+                next_on = lifted + job.settle_time(i)
+                self.records.append({"layer": i,
+                                     "on": on,
+                                     "off": off,
+                                     "on_late": on - planned_on,
+                                     "exposure": off - lit,
+                                     "exposure_error": off - lit - exposure,
+                                     "lift_late": lifted - lift_wait - planned_lift,
+                                     "lift_wait": lift_wait,
+                                     "latency": self.latency})
+                planned_on = next_on
+            else:
+                self.completed = True
+        except Exception:
+            logging.error("Exposure scheduler died:\n" + traceback.format_exc())
+        finally:
+            # So the display is done with the last layer before the end
+            self._end_progress()
+            job.finish(self.completed)
+
+    def report(self):
+        """Jitter summary over the layers run so far, in seconds"""
+        summary = {"layers": len(self.records)}
+        for key in ("on_late", "exposure_error", "lift_late"):
+            values = [abs(r[key]) for r in self.records]
+            summary[key] = {"p50": percentile(values, 0.5),
+                            "p95": percentile(values, 0.95),
+                            "max": max(values) if values else 0.0}
+        return summary
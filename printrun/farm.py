@@ -0,0 +1,346 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Supervises several printers from one process: a shared queue of G-code
+# jobs is handed out to whichever printer is idle, every printer is driven
+# by a loopcore on one event loop, and their state is gathered in one
+# place.
+#
+#   python -m printrun.farm -p left=192.168.1.20:23 -p right=/dev/ttyACM0 \
+#       part1.gcode part2.gcode ...
+
+import os
+import sys
+import time
+import logging
+import argparse
+import traceback
+from threading import Thread, Event
+from collections import deque
+
+from printrun import gcoder
+from printrun.loopcore import loopcore
+from printrun.eventloop import EventLoop
+from printrun.printrun_utils import monotonic
+
+class FarmJob(object):
+    """A G-code job on the farm queue.
+
+    state is one of queued, printing, done or failed."""
+
+    def __init__(self, path = None, gcode = None, name = None):
+        if gcode is None:
+            with open(path) as f:
+                gcode = gcoder.GCode(f)
+        self.path = path
+        self.gcode = gcode
+        self.name = name or (os.path.basename(path) if path else "job")
+        self.state = "queued"
+        self.printer = None
+        self.attempts = 0
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def __len__(self):
+        return len(self.gcode)
+
+class FarmPrinter(object):
+    """One printer of the farm and what is known about it.
+
+    state is one of offline, idle or printing."""
+
+    def __init__(self, farm, name, port, baud = 115200, window = 0):
+        self.farm = farm
+        self.name = name
+        self.port = port
+        self.baud = baud
+        self.state = "offline"
+        self.job = None
+        self.temperature = None
+        self.last_seen = None
+        self.errors = deque(maxlen = 20)
+        self.jobs_done = 0
+        self.lines_done = 0
+        self.rate = 0.0
+        self.sampled = (monotonic(), 0)
+        self.connecting = False
+        self.core = core = loopcore(loop = farm.loop)
+        core.window = window
+        # The farm does not use the analyzer
+        core.analyze = False
+        core.onlinecb = self._online
+        core.recvcb = self._received
+        core.tempcb = self._temperature
+        core.errorcb = self._error
+        core.endcb = self._ended
+
+    def connect(self):
+        """Connect from a thread of its own, as opening a port can block"""
+        if self.connecting:
+            return
+        self.connecting = True
+        def run():
+            try:
+                self.core.connect(self.port, self.baud)
+            finally:
+                self.connecting = False
+        thread = Thread(target = run, name = "connect-%s" % self.name)
+        thread.daemon = True
+        thread.start()
+
+    def progress(self):
+        if self.job is None or not len(self.job):
+            return 0.0
+        return float(self.core.queueindex) / len(self.job)
+
+    # The core calls these from its events bus thread, the bookkeeping
+    # they lead to is done on the loop
+
+    def _online(self):
+        self.farm.loop.call_soon(self._idle)
+
+    def _idle(self):
+        self.state = "idle"
+        self.farm._dispatch()
+
+    def _received(self, line):
+        self.last_seen = time.time()
+
+    def _temperature(self, line):
+        self.temperature = line.strip()
+
+    def _error(self, error):
+        self.errors.append((time.time(), error))
+        logging.warning("%s: %s" % (self.name, error))
+
+    def _ended(self):
+        self.farm.loop.call_soon(self._job_ended)
+
+    def _job_ended(self):
+        self.farm._job_ended(self, self.core.completed)
+
+    def sample(self):
+        """Update the lines per second figure"""
+        now = monotonic()
+        done = self.core.queueindex if self.state == "printing" else 0
+        then, before = self.sampled
+        if now > then and done >= before:
+            self.rate = (done - before) / (now - then)
+        else:
+            self.rate = 0.0
+        self.sampled = (now, done)
+
+    def status(self):
+        return {"name": self.name,
+                "port": self.port,
+                "state": self.state,
+                "job": self.job.name if self.job else None,
+                "progress": self.progress(),
+                "lines_per_second": self.rate,
+                "temperature": self.temperature,
+                "last_seen": self.last_seen,
+                "jobs_done": self.jobs_done,
+                "lines_done": self.lines_done,
+                "errors": len(self.errors)}
+
+class Farm(object):
+    """A queue of jobs and the printers that print them.
+
+    Jobs go to idle printers in the order they were submitted. A job whose
+    printer drops off in the middle goes back to the front of the queue,
+    up to max_attempts times. Every interval seconds each printer is asked
+    for its temperature and disconnected ones are reconnected.
+
+    All the bookkeeping runs on the farm's event loop; submit, add_printer
+    and status may be called from any thread."""
+
+    interval = 5.0
+    max_attempts = 3
+
+    def __init__(self, loop = None):
+        self.own_loop = loop is None
+        if loop is None:
+            loop = EventLoop()
+            loop.start()
+        self.loop = loop
+        self.printers = []
+        self.queue = deque()
+        self.jobs = []
+        self.poll_timer = None
+        self.idle = Event()
+        self.idle.set()
+
+    def add_printer(self, name, port, baud = 115200, window = 0):
+        printer = FarmPrinter(self, name, port, baud, window)
+        self.loop.call_soon(self._add_printer, printer)
+        return printer
+
+    def _add_printer(self, printer):
+        self.printers.append(printer)
+        printer.connect()
+
+    def submit(self, job):
+        self.idle.clear()
+        self.loop.call_soon(self._submit, job)
+        return job
+
+    def _submit(self, job):
+        self.jobs.append(job)
+        self.queue.append(job)
+        self._dispatch()
+
+    def start(self):
+        self.loop.call_soon(self._poll)
+
+    def stop(self):
+        if self.poll_timer:
+            self.poll_timer.cancel()
+        for printer in list(self.printers):
+            printer.core.disconnect()
+        if self.own_loop:
+            self.loop.stop()
+
+    def wait(self, timeout = None):
+        """Block until every job submitted is done or failed"""
+        return self.idle.wait(timeout)
+
+    def _dispatch(self):
+        for printer in self.printers:
+            if not self.queue:
+                break
+            if printer.state != "idle" or not printer.core.online:
+                continue
+            job = self.queue.popleft()
+            if not printer.core.startprint(job.gcode):
+                self.queue.appendleft(job)
+                continue
+            job.state = "printing"
+            job.printer = printer.name
+            job.attempts += 1
+            job.started = time.time()
+            printer.job = job
+            printer.state = "printing"
+            printer.sampled = (monotonic(), 0)
+        self._check_idle()
+
+    def _job_ended(self, printer, completed):
+        job = printer.job
+        printer.job = None
+        if printer.state == "printing":
+            printer.state = "idle" if printer.core.online else "offline"
+        if job is None:
+            return
+        if completed:
+            job.state = "done"
+            job.finished = time.time()
+            printer.jobs_done += 1
+            printer.lines_done += len(job)
+        else:
+            self._retry(job)
+        self._dispatch()
+
+    def _retry(self, job):
+        if job.attempts < self.max_attempts:
+            job.state = "queued"
+            job.printer = None
+            self.queue.appendleft(job)
+        else:
+            job.state = "failed"
+            job.finished = time.time()
+            logging.error(_("Job %s failed after %d attempts") % (job.name, job.attempts))
+
+    def _check_idle(self):
+        if not self.queue and not any(p.job for p in self.printers):
+            self.idle.set()
+
+    def _poll(self):
+        try:
+            for printer in self.printers:
+                core = printer.core
+                if not core.printer or not core.online:
+                    if printer.job is not None:
+                        # Lost in the middle of a job
+                        job = printer.job
+                        printer.job = None
+                        self._retry(job)
+                    printer.state = "offline"
+                    printer.rate = 0.0
+                    if not core.printer:
+                        printer.connect()
+                    continue
+                printer.sample()
+                core.send_now("M105")
+            self._dispatch()
+        except Exception:
+            logging.error(_("Farm poll failed:") + "\n" + traceback.format_exc())
+        self.poll_timer = self.loop.call_later(self.interval, self._poll)
+
+    def status(self):
+        """Aggregated telemetry: every printer, and job counts by state"""
+        printers = [printer.status() for printer in list(self.printers)]
+        jobs = {"queued": 0, "printing": 0, "done": 0, "failed": 0}
+        for job in list(self.jobs):
+            jobs[job.state] += 1
+        return {"printers": printers,
+                "jobs": jobs,
+                "lines_per_second": sum(p["lines_per_second"] for p in printers)}
+
+    def format_status(self):
+        status = self.status()
+        lines = ["%-12s %-9s %-20s %6s %8s %s" % ("printer", "state", "job", "done", "lines/s", "temperature")]
+        for p in status["printers"]:
+            lines.append("%-12s %-9s %-20s %5.1f%% %8.0f %s" % (p["name"], p["state"], (p["job"] or "-")[:20],
+                                                              100 * p["progress"], p["lines_per_second"],
+                                                              p["temperature"] or "-"))
+        jobs = status["jobs"]
+        lines.append("jobs: %d queued, %d printing, %d done, %d failed; %.0f lines/s" % (
+            jobs["queued"], jobs["printing"], jobs["done"], jobs["failed"], status["lines_per_second"]))
+        return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Print a queue of G-code jobs on several printers")
+    parser.add_argument("-p", "--printer", action = "append", default = [], metavar = "NAME=PORT",
+                        help = "a printer, by serial port or host:port; repeat for each")
+    parser.add_argument("-b", "--baud", type = int, default = 115200)
+    parser.add_argument("--rx-buffer", type = int, default = 0,
+                        help = "firmware receive buffer to stream against, in bytes")
+    parser.add_argument("--interval", type = float, default = Farm.interval,
+                        help = "seconds between status updates")
+    parser.add_argument("jobs", nargs = "*")
+    args = parser.parse_args()
+    if not args.printer:
+        parser.error("no printers given")
+    farm = Farm()
+    farm.interval = args.interval
+    for index, spec in enumerate(args.printer):
+        name, sep, port = spec.partition("=")
+        if not sep:
+            name, port = "printer%d" % (index + 1), spec
+        farm.add_printer(name, port, args.baud, args.rx_buffer)
+    for path in args.jobs:
+        farm.submit(FarmJob(path))
+    farm.start()
+    try:
+        while not farm.wait(args.interval):
+            print farm.format_status()
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    print farm.format_status()
+    farm.stop()
+
+if __name__ == "__main__":
+    main()
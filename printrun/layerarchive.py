@@ -0,0 +1,234 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Pre-rendered layer archives: a zip holding every layer of a job as an
+# image, so a slow printer never has to rasterize while printing.
+#
+# manifest.json describes the job:
+#
+#   {"version": 1,
+#    "format": "raw1" or "png",
+#    "width": 1920, "height": 1080,      layer size in pixels
+#    "dpi": 96.5,                        resolution the layers were made at
+#    "layer_height": 0.05,               mm
+#    "layers": [{"file": "layers/00000.raw", "z": 0.05, "exposure": 12.0},
+#               ...]}
+#
+# "exposure" is optional and overrides the job's exposure time for that
+# layer. raw1 members are 1-bit images, rows packed MSB first and padded to
+# a whole byte; png members are any PNG cairo can read. Identical layers
+# may point at the same member.
+
+import os
+import sys
+import zlib
+import struct
+import zipfile
+import argparse
+import cStringIO
+import numpy
+from threading import Lock
+
+try: import simplejson as json
+except ImportError: import json
+
+from printrun import raster, rasterizer
+from printrun.raster import Raster
+
+MANIFEST = "manifest.json"
+VERSION = 1
+
+def pack_raw1(layer):
+    """Pack a Raster into a raw1 member, anything not black is lit"""
+    return numpy.packbits(layer.array() > 127, axis=1).tostring()
+
+def unpack_raw1(data, width, height):
+    bits = numpy.frombuffer(data, numpy.uint8).reshape(height, (width + 7) // 8)
+    pixels = numpy.unpackbits(bits, axis=1)[:, :width]
+    pixels *= 255
+    return Raster(width, height, pixels.tostring())
+
+def _png_chunk(kind, data):
+    return (struct.pack(">I", len(data)) + kind + data +
+            struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+def encode_png(layer):
+    """8-bit greyscale PNG of a Raster"""
+    rows = numpy.zeros((layer.height, layer.width + 1), numpy.uint8)
+    # Filter type 0 in front of every row
+    rows[:, 1:] = layer.array()
+    return ("\x89PNG\r\n\x1a\n" +
+            _png_chunk("IHDR", struct.pack(">IIBBBBB", layer.width, layer.height, 8, 0, 0, 0, 0)) +
+            _png_chunk("IDAT", zlib.compress(rows.tostring(), 6)) +
+            _png_chunk("IEND", ""))
+
+def decode_png(data):
+    import cairo
+    return raster.from_cairo(cairo.ImageSurface.create_from_png(cStringIO.StringIO(data)))
+
+class ArchiveLayer(object):
+    """One layer of a LayerArchive, decoded when raster() is called"""
+
+    __slots__ = ('archive', 'index', 'name', 'z', 'thickness', 'exposure', 'digest')
+
+    def __init__(self, archive, index, name, z, thickness, exposure, digest):
+        self.archive = archive
+        self.index = index
+        self.name = name
+        self.z = z
+        self.thickness = thickness
+        self.exposure = exposure
+        self.digest = digest
+
+    def raster(self):
+        return self.archive.decode(self.name)
+
+class LayerArchive(object):
+    """A job made of pre-rendered layers, see the top of this file.
+
+    Only the manifest is read on open; members are read and decoded when a
+    layer is asked for, so the archive is never unpacked as a whole."""
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path, "r")
+        # ZipFile shares one file position between readers
+        self.lock = Lock()
+        try:
+            manifest = json.loads(self.zip.read(MANIFEST))
+        except KeyError:
+            raise ValueError("%s has no %s" % (path, MANIFEST))
+        if manifest.get("version", VERSION) > VERSION:
+            raise ValueError("%s is a version %s layer archive" % (path, manifest["version"]))
+        self.format = manifest.get("format", "raw1")
+        if self.format not in ("raw1", "png"):
+            raise ValueError("Unknown layer format %s" % self.format)
+        self.width = int(manifest["width"])
+        self.height = int(manifest["height"])
+        self.dpi = float(manifest.get("dpi", 0))
+        self.layer_height = float(manifest.get("layer_height", 0))
+        self.layers = []
+        digests = set()
+        last_z = 0.0
+        for index, entry in enumerate(manifest["layers"]):
+            info = self.zip.getinfo(entry["file"])
+            # Members with the same contents can share a raster
+            digest = "%08x-%d" % (info.CRC & 0xffffffff, info.file_size)
+            digests.add(digest)
+            z = float(entry.get("z", (index + 1) * self.layer_height))
+            exposure = entry.get("exposure")
+            self.layers.append(ArchiveLayer(self, index, entry["file"], z, z - last_z,
+                                            float(exposure) if exposure is not None else None,
+                                            digest))
+            last_z = z
+        self.unique = len(digests)
+
+    def decode(self, name):
+        with self.lock:
+            data = self.zip.read(name)
+        if self.format == "raw1":
+            return unpack_raw1(data, self.width, self.height)
+        layer = decode_png(data)
+        if (layer.width, layer.height) != (self.width, self.height):
+            raise ValueError("%s is %dx%d, expected %dx%d" % (name, layer.width, layer.height,
+                                                           self.width, self.height))
+        return layer
+
+    def dedup_ratio(self):
+        if not self.layers:
+            return 0.0
+        return 1.0 - float(self.unique) / len(self.layers)
+
+    def close(self):
+        self.zip.close()
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __getitem__(self, index):
+        return self.layers[index]
+
+    def __iter__(self):
+        return iter(self.layers)
+
+def render_slice(layer, dpi, antialias=rasterizer.cairo_rows):
+    """Rasterize a SliceFile layer, with the NumPy rasterizer if it can"""
+    source = layer.source
+    if source.slicer == 'Slic3r' and rasterizer.supported(layer.data()):
+        return rasterizer.rasterize(layer.data(), source.width, source.height, dpi, supersample=antialias)
+    from cairosvg.surface import PNGSurface
+    from cairosvg.parser import Tree
+    return raster.from_cairo(PNGSurface(Tree(bytestring=layer.svg()), None, dpi).cairo)
+
+def build(svg, path, dpi, format="raw1", exposures=None, antialias=rasterizer.cairo_rows, progress=None):
+    """Render every layer of the sliced SVG svg into a layer archive at
+    path. exposures optionally maps layer indices to exposure times.
+    Layers with the same geometry are stored once."""
+    from printrun.svgslices import SliceFile
+    slices = SliceFile(svg)
+    exposures = exposures or {}
+    compression = zipfile.ZIP_DEFLATED if format == "raw1" else zipfile.ZIP_STORED
+    extension = ".raw" if format == "raw1" else ".png"
+    members = {}
+    entries = []
+    width = height = 0
+    tmp = path + ".part"
+    with zipfile.ZipFile(tmp, "w", compression) as archive:
+        for index, layer in enumerate(slices):
+            name = members.get(layer.digest)
+            if name is None:
+                image = render_slice(layer, dpi, antialias if format == "png" else 1)
+                width, height = image.width, image.height
+                name = members[layer.digest] = "layers/%05d%s" % (index, extension)
+                archive.writestr(name, pack_raw1(image) if format == "raw1" else encode_png(image))
+            entry = {"file": name, "z": layer.z}
+            if index in exposures:
+                entry["exposure"] = exposures[index]
+            entries.append(entry)
+            if progress:
+                progress(index, len(slices))
+        archive.writestr(MANIFEST, json.dumps({"version": VERSION,
+                                               "format": format,
+                                               "width": width,
+                                               "height": height,
+                                               "dpi": dpi,
+                                               "layer_height": slices.zdiff,
+                                               "layers": entries}, indent=1))
+    slices.close()
+    os.rename(tmp, path)
+    return len(entries), len(members)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Pre-render a sliced SVG into a layer archive")
+    parser.add_argument("svg")
+    parser.add_argument("archive")
+    parser.add_argument("--resolution", default = "1024x768",
+                        help = "projector resolution in pixels, e.g. 1920x1200")
+    parser.add_argument("--projected-width", type = float, default = 150.0,
+                        help = "width of the projected image in mm")
+    parser.add_argument("--format", choices = ("raw1", "png"), default = "raw1")
+    parser.add_argument("--antialias", type = int, default = rasterizer.cairo_rows)
+    args = parser.parse_args()
+    # Same as SettingsFrame.get_dpi
+    dpi = int(args.resolution.split("x")[0]) / (args.projected_width / 25.4)
+    def progress(index, count):
+        sys.stdout.write("\r%d/%d" % (index + 1, count))
+        sys.stdout.flush()
+    layers, unique = build(args.svg, args.archive, dpi, args.format, antialias = args.antialias,
+                           progress = progress)
+    print "\n%d layers, %d stored" % (layers, unique)
+
+if __name__ == "__main__":
+    main()
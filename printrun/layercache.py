@@ -0,0 +1,122 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import struct
+import hashlib
+import tempfile
+import zlib
+import logging
+
+from printrun.raster import Raster
+
+# Entry layout: magic, width, height, then the zlib-compressed greyscale
+# pixels. Layers are mostly black, so they compress very well.
+HEADER = struct.Struct("<4sII")
+MAGIC = "RLC1"
+
+class LayerCache(object):
+    """Persistent store of rasterized layers, so that a part is only
+    rasterized once no matter how many times it is printed"""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, svg, dpi, scale, size, renderer="cairosvg"):
+        h = hashlib.sha1(svg)
+        h.update("|%r|%r|%dx%d|%s" % (float(dpi), float(scale), int(size[0]), int(size[1]), renderer))
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        entry = self._entry(key)
+        try:
+            with open(entry, "rb") as f:
+                blob = f.read()
+            magic, width, height = HEADER.unpack_from(blob)
+            if magic != MAGIC:
+                raise ValueError("bad magic")
+            data = zlib.decompress(blob[HEADER.size:])
+            if len(data) != width * height:
+                raise ValueError("truncated entry")
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        except (ValueError, struct.error, zlib.error) as e:
+            logging.warning("Discarding corrupt layer cache entry %s: %s" % (key, e))
+            self.discard(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touch(entry)
+        return Raster(width, height, data)
+
+    def touch(self, entry):
+        """Mark entry as just used, prune goes by modification time as
+        access times are often not kept (noatime, relatime)"""
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+
+    def put(self, key, raster):
+        entry = self._entry(key)
+        try:
+            if not os.path.isdir(os.path.dirname(entry)):
+                os.makedirs(os.path.dirname(entry))
+            # Write then rename so an interrupted print never leaves a
+            # half-written entry behind
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry))
+            with os.fdopen(fd, "wb") as f:
+                f.write(HEADER.pack(MAGIC, raster.width, raster.height))
+                f.write(zlib.compress(raster.data))
+            os.rename(tmp, entry)
+        except (IOError, OSError) as e:
+            logging.warning("Could not store layer in cache %s: %s" % (self.path, e))
+
+    def discard(self, key):
+        try:
+            os.remove(self._entry(key))
+        except OSError:
+            pass
+
+    def prune(self, max_bytes):
+        """Drop the least recently used entries, written or read, until the
+        cache fits in max_bytes"""
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        return total
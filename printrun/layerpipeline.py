@@ -0,0 +1,119 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import logging
+import traceback
+from threading import Thread, Condition
+
+from printrun.printrun_utils import monotonic
+
+class LayerPipeline(object):
+    """Renders upcoming layers in worker threads while the current one is
+    exposing, so the display path only has to pick up finished rasters.
+
+    render(index) is called from the workers and must not touch wx. At most
+    depth layers are rendered ahead of the last one handed out by get()."""
+
+    def __init__(self, render, count, depth=3, workers=1):
+        self.render = render
+        self.count = count
+        self.depth = max(1, depth)
+        self.nworkers = max(1, workers)
+        self.cv = Condition()
+        self.ready = {}
+        self.next_index = 0
+        self.consumed = 0
+        self.running = False
+        self.workers = []
+        self.gets = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def start(self, index=0):
+        with self.cv:
+            self.next_index = index
+            self.consumed = index
+            self.ready = {}
+            self.running = True
+        for i in range(self.nworkers):
+            worker = Thread(target=self._work, name="layer-render-%d" % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        with self.cv:
+            self.running = False
+            self.ready = {}
+            self.cv.notify_all()
+        self.workers = []
+
+    def _work(self):
+        while True:
+            with self.cv:
+                while self.running and (self.next_index >= self.count or
+                                        self.next_index - self.consumed >= self.depth):
+                    self.cv.wait()
+                if not self.running:
+                    return
+                index = self.next_index
+                self.next_index += 1
+            try:
+                result = (self.render(index), None)
+            except Exception:
+                logging.error("Rendering layer %d failed:\n%s" % (index, traceback.format_exc()))
+                result = (None, sys.exc_info())
+            with self.cv:
+                if self.running and index >= self.consumed:
+                    self.ready[index] = result
+                    self.cv.notify_all()
+
+    def get(self, index):
+        """Return the rendered layer index, waiting for the workers if they
+        have not finished it yet"""
+        with self.cv:
+            self.gets += 1
+            if index not in self.ready:
+                if index >= self.next_index or index < self.consumed:
+                    # Out of order request (seek), restart from there
+                    self.next_index = index
+                    self.ready = {}
+                self.consumed = index
+                self.cv.notify_all()
+                self.waits += 1
+                start = monotonic()
+                while self.running and index not in self.ready:
+                    self.cv.wait()
+                waited = monotonic() - start
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+                if index not in self.ready:
+                    return None
+            layer, error = self.ready.pop(index)
+            self.consumed = index + 1
+            self.cv.notify_all()
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return layer
+
+    def stats(self):
+        return {"layers": self.gets,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "max_wait": self.max_wait,
+                "depth": self.depth,
+                "workers": self.nworkers}
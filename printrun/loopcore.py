@@ -0,0 +1,1111 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import sys
+reload(sys).setdefaultencoding('utf8')
+import errno
+import select
+import socket
+import logging
+import platform
+import operator
+import termios
+import traceback
+from array import array
+from Queue import Queue
+from threading import Thread, Event, Lock
+from collections import deque
+
+from serial import Serial, SerialException
+
+from printrun import gcoder
+from printrun.eventloop import LineSplitter, default_loop, set_nonblocking
+from printrun.eventbus import Channel, callback, COALESCE
+from printrun.session import SessionRecorder, SERIAL, TCP
+from printrun.printrun_utils import install_locale, decode_utf8, setup_logging, \
+    monotonic
+install_locale('pronterface')
+
+setup_logging(sys.stderr)
+
+def control_ttyhup(port, disable_hup):
+    """Controls the HUPCL, of the device at path port or of an open file
+    descriptor"""
+    if platform.system() != "Linux":
+        return
+    fd = port
+    opened = not isinstance(port, int)
+    if opened:
+        try:
+            fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        except OSError:
+            return
+    try:
+        attrs = termios.tcgetattr(fd)
+        if disable_hup:
+            attrs[2] &= ~termios.HUPCL
+        else:
+            attrs[2] |= termios.HUPCL
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    except termios.error:
+        pass
+    finally:
+        if opened:
+            os.close(fd)
+
+def enable_hup(port):
+    control_ttyhup(port, False)
+
+def disable_hup(port):
+    control_ttyhup(port, True)
+
+# Connect to socket if "port" is an IP or host name and a port number
+host_regexp = re.compile("^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])$|^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$")
+
+def tcp_address(port):
+    """(host, port number) if port is host:port, None for a device"""
+    bits = port.split(":")
+    if len(bits) != 2 or not host_regexp.match(bits[0]):
+        return None
+    try:
+        number = int(bits[1])
+    except ValueError:
+        return None
+    if not 1 <= number <= 65535:
+        return None
+    return bits[0], number
+
+class Ack(object):
+    """Follows a command queued with send_now(command, ack = Ack()): when
+    it was written to the printer and when the printer acknowledged it.
+    callback, if given, is called with the Ack from the events bus thread
+    once the ok arrives."""
+
+    def __init__(self, callback = None):
+        self.callback = callback
+        self.sent = None
+        self.acked = None
+        self.event = Event()
+
+    def wait(self, timeout = None):
+        return self.event.wait(timeout)
+
+    def latency(self):
+        if self.sent is None or self.acked is None:
+            return None
+        return self.acked - self.sent
+
+def analyzer_state(analyzer, behind):
+    return {"abs_pos": analyzer.abs_pos,
+            "current_pos": analyzer.current_pos,
+            "home_pos": analyzer.home_pos,
+            "abs_e": analyzer.abs_e,
+            "feedrate": analyzer.current_f,
+            "relative": analyzer.relative,
+            "relative_e": analyzer.relative_e,
+            "imperial": analyzer.imperial,
+            "tool": analyzer.current_tool,
+            "behind": behind}
+
+class ResendOverflow(LookupError):
+    """The firmware asked for a line that is no longer kept"""
+
+class SentLines(object):
+    """The last capacity checksummed lines of a print by line number, in
+    a fixed ring so a long print does not grow memory. Asking for a line
+    that has been overwritten raises ResendOverflow."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.clear()
+
+    def clear(self):
+        self.numbers = [-1] * self.capacity
+        self.lines = [None] * self.capacity
+
+    def __setitem__(self, lineno, command):
+        slot = lineno % self.capacity
+        self.numbers[slot] = lineno
+        self.lines[slot] = command
+
+    def __getitem__(self, lineno):
+        slot = lineno % self.capacity
+        if lineno < 0 or self.numbers[slot] != lineno:
+            raise ResendOverflow(_("Printer asked to resend line %d, only the last %d lines are kept")
+                                 % (lineno, self.capacity))
+        return self.lines[slot]
+
+    def __contains__(self, lineno):
+        return lineno >= 0 and self.numbers[lineno % self.capacity] == lineno
+
+class CompiledJob(object):
+    """A print job laid out for the wire ahead of printing.
+
+    Every line from first on is stripped of its comment, numbered,
+    checksummed and encoded once, and the results are packed into one
+    string. Sending line i is then a slice of data between starts[i] and
+    starts[i + 1]; lines with nothing to send are empty slices. Host
+    commands (;@pause) and layer changes are kept out of band in hosts and
+    layers, keyed by queue index. Line numbers count from 0 at the first
+    line sent from first, so the job can be resumed anywhere after first
+    by telling the firmware the line number with M110."""
+
+    def __init__(self, gcode, first = 0, checksums = True):
+        self.gcode = gcode
+        self.first = first
+        self.count = len(gcode)
+        self.checksums = checksums
+        self.hosts = {}
+        self.layers = {}
+        starts = array('I', [0]) * (self.count - first + 1)
+        linenos = array('i', [-1]) * (self.count - first)
+        chunks = []
+        offset = 0
+        lineno = 0
+        layer_idxs = gcode.layer_idxs
+        for i in xrange(first, self.count):
+            if i > 0 and layer_idxs[i] != layer_idxs[i - 1]:
+                self.layers[i] = layer_idxs[i]
+            raw = gcode.lines[i].raw
+            if raw.lstrip().startswith(";@"):
+                self.hosts[i] = raw
+            else:
+                tline = str(raw.split(";")[0])
+                if tline:
+                    if checksums:
+                        prefix = "N%d %s" % (lineno, tline)
+                        tline = "%s*%d" % (prefix, reduce(operator.xor, bytearray(prefix), 0))
+                    chunks.append(tline + "\n")
+                    offset += len(tline) + 1
+                    linenos[i - first] = lineno
+                    lineno += 1
+            starts[i - first + 1] = offset
+        self.data = "".join(chunks)
+        self.starts = starts
+        self.linenos = linenos
+        self.lines = lineno
+
+    def lineno_at(self, index):
+        """Number of the first line sent from queue index on"""
+        for k in xrange(index - self.first, self.count - self.first):
+            if self.linenos[k] >= 0:
+                return self.linenos[k]
+        return self.lines
+
+# send_now priorities, most urgent first. Emergency commands are written at
+# once, the others wait their turn in a CommandQueue.
+EMERGENCY = 0
+MOTION = 1
+STATUS = 2
+priority_names = ("emergency", "motion", "status")
+
+def command_priority(command, emergency_commands, status_commands):
+    code = command.split(None, 1)[0].upper() if command.strip() else ""
+    if code in emergency_commands:
+        return EMERGENCY
+    if code in status_commands:
+        return STATUS
+    return MOTION
+
+class CommandQueue(Queue):
+    """The commands sent with send_now, a FIFO for each priority: items
+    are put as (priority, item) and get() returns the oldest item of the
+    most urgent level. Each level counts the commands it handed out and
+    how long they waited.
+
+    Whoever gets an item calls task_done() as soon as it has it, wakeups
+    included, so join() returns once everything put has been taken."""
+
+    def _init(self, maxsize):
+        self.levels = [deque() for name in priority_names]
+        self.taken = [0] * len(priority_names)
+        self.waited = [0.0] * len(priority_names)
+        self.longest = [0.0] * len(priority_names)
+
+    def _qsize(self, len = len):
+        return sum(len(level) for level in self.levels)
+
+    def _put(self, item):
+        priority, item = item
+        self.levels[priority].append((monotonic(), item))
+
+    def _get(self):
+        for priority, level in enumerate(self.levels):
+            if level:
+                queued, item = level.popleft()
+                if item is not None:
+                    self._count(priority, monotonic() - queued)
+                return item
+
+    def _count(self, priority, waited):
+        self.taken[priority] += 1
+        self.waited[priority] += waited
+        if waited > self.longest[priority]:
+            self.longest[priority] = waited
+
+    def put_many(self, priority, items):
+        """Put every one of items at priority in one step, so a consumer
+        woken by the first finds the others already there. The queue is
+        never bounded, so this does not block."""
+        if not items:
+            return
+        with self.mutex:
+            for item in items:
+                self._put((priority, item))
+            self.unfinished_tasks += len(items)
+            self.not_empty.notify()
+
+    def count(self, priority, waited):
+        """Count a command that did not go through the queue"""
+        with self.mutex:
+            self._count(priority, waited)
+
+    def stats(self):
+        """Commands waiting, commands sent and their mean and longest wait
+        in seconds, by priority name"""
+        with self.mutex:
+            return dict((name, {"depth": len(self.levels[i]),
+                                "sent": self.taken[i],
+                                "mean_wait": self.waited[i] / self.taken[i] if self.taken[i] else 0.0,
+                                "max_wait": self.longest[i]})
+                        for i, name in enumerate(priority_names))
+
+class loopcore(object):
+    """The host side of the printer protocol, driven by an EventLoop
+    instead of threads of its own.
+
+    connect, disconnect, startprint, pause, resume and the recording calls
+    may be made from any thread and return once the loop has carried them
+    out; send and send_now queue the command and return at once.
+    Everything else happens in callbacks on the loop thread, woken by data
+    from the printer rather than by read timeouts, so one loop (by default
+    the shared default_loop()) can drive many printers next to the rest of
+    the program.
+
+    The callbacks, Ack ones included, are called from the thread of the
+    loop's events bus, which every printer on the loop shares, so a slow
+    one holds up no printer's I/O; only the latest temperature is kept
+    for a tempcb that falls behind. preprintsendcb is the exception: it changes the lines being
+    sent, so it is called from the loop thread and must not block.
+    printcore is this class with a few additions for older callers."""
+
+    tempcb = callback("temp", COALESCE)
+    recvcb = callback("recv")
+    sendcb = callback("send")
+    printsendcb = callback("printsend")
+    layerchangecb = callback("layerchange")
+    errorcb = callback("error")
+    startcb = callback("start")
+    endcb = callback("end")
+    onlinecb = callback("online")
+
+    # Seconds between probes while waiting for the printer to come online,
+    # at first probe_initial, doubled each time up to probe_interval. A
+    # board that does not reset on connect answers the first probe at once;
+    # 3.75s gives the Gen7 bootloader enough time to time out.
+    probe_initial = 0.25
+    probe_interval = 3.75
+    # Most lines written in one go before letting the other printers on
+    # the loop have a turn, and bytes buffered before writing them out
+    round_lines = 256
+    chunk = 4096
+    # Longest wait for an ok while waiting for the lines in flight at a
+    # resend request to be answered. Marlin throws away the rest of its
+    # receive buffer when it asks for a resend, and the lines in it never
+    # get an ok.
+    drain_timeout = 1.0
+
+    def __init__(self, port = None, baud = None, loop = None):
+        self.loop = loop or default_loop()
+        self.baud = None
+        self.port = None
+        self.printer = None
+        self.printer_tcp = None
+        self.fd = None
+        self.splitter = LineSplitter()
+        self.outbuf = bytearray()
+        self.writing = False
+        self.probe = None
+        self.probe_wait = self.probe_initial
+        # Where the time of the last connect went: seconds from the start
+        # of connect to the port being open, the printer's first line and
+        # it being online; seconds taken to clear HUPCL, and the number of
+        # probes sent
+        self.connect_stats = {}
+        self.connect_started = None
+        self.clear = False  # clear to send, enabled after responses
+        self.online = False  # The printer has responded to the initial command
+                             # and is active
+        self.printing = False  # is a print currently running, true if printing
+                               # , false if paused
+        self.paused = False
+        # Whether the last print ran to its end
+        self.completed = False
+        self.mainqueue = None
+        # CompiledJob of mainqueue, or None to send it line by line
+        self.compiled = None
+        # Set while the print being started is compiled
+        self.compiling = None
+        self.priqueue = CommandQueue(0)
+        # Commands send_now writes at once, ahead of everything queued and
+        # without waiting for the printer to be clear (G94 closes the
+        # servo on this machine), and those it sends after the others
+        self.emergency_commands = ["M112", "G94"]
+        self.status_commands = ["M105", "M114", "M27", "M119"]
+        self.queueindex = 0
+        self.lineno = 0
+        self.resendfrom = -1
+        # How far back the firmware can ask for a resend, in lines. Raised
+        # to the receive buffer size when streaming, as every line in it
+        # is at least a byte.
+        self.resend_history = 1024
+        self.sentlines = SentLines(self.resend_history)
+        self.log = deque(maxlen = 10000)
+        self.sent = deque(maxlen = 10000)
+        # One (length, Ack or None, emergency) entry per line written and
+        # not yet answered by an ok, oldest first
+        self.inflight = deque()
+        self.inflight_bytes = 0
+        # Size of the firmware's receive buffer in bytes. When set, lines
+        # are streamed for as long as they fit in it instead of waiting for
+        # the ok of each one (character counting, as Grbl streamers do).
+        # The firmware has to answer every line, rejected ones included,
+        # with an ok.
+        self.window = 0
+        # Waiting for the lines in flight at a resend request to be
+        # answered before resending, for no longer than drain_timeout
+        # between oks
+        self.draining = False
+        self.drain_timer = None
+        # A line made but not written yet, waiting for room in the window
+        self.held = None
+        self.writefailures = 0
+        # Follows the printer's state through the commands sent. It is fed
+        # from the events bus thread once each round is written, so it lags
+        # behind the writes; read it with analyzer_snapshot(). Set analyze
+        # to False to skip it.
+        self.analyzer = gcoder.GCode()
+        self.analyze = True
+        self.analyzer_lock = Lock()
+        # Commands written and not analyzed yet, appended to from the loop
+        # and taken from the bus thread
+        self.unanalyzed = deque()
+        self.analyzing = False
+        # Subscriptions on the bus shared by everything on the loop
+        self.events = Channel(self.loop.events, type(self).__name__)
+        # Takes down every byte sent and received, see start_recording
+        self.recorder = None
+        self.tempcb = None  # impl (wholeline)
+        self.recvcb = None  # impl (wholeline)
+        self.sendcb = None  # impl (wholeline)
+        self.preprintsendcb = None  # impl (wholeline)
+        self.printsendcb = None  # impl (wholeline)
+        self.layerchangecb = None  # impl (wholeline)
+        self.errorcb = None  # impl (wholeline)
+        self.startcb = None  # impl ()
+        self.endcb = None  # impl ()
+        self.onlinecb = None  # impl ()
+        self.loud = False  # emit sent and received lines to terminal
+        self.greetings = ['start', 'Grbl ']
+        self.pronterface = None
+        if port is not None and baud is not None:
+            self.connect(port, baud)
+
+    def logError(self, error):
+        if self.events.subscribed("error"):
+            self.events.publish("error", error)
+        else:
+            logging.error(error)
+
+    def _checksum(self, command):
+        return reduce(lambda x, y: x ^ y, map(ord, command))
+
+    def analyzer_snapshot(self):
+        """The printer state as far as the analyzer has got, which may be a
+        few commands behind what was written"""
+        with self.analyzer_lock:
+            return analyzer_state(self.analyzer, len(self.unanalyzed))
+
+    def _call(self, fn, *args):
+        """Run fn on the loop thread and wait for it"""
+        if self.loop.in_loop():
+            return fn(*args)
+        done = Event()
+        result = []
+        def run():
+            try:
+                result.append(fn(*args))
+            finally:
+                done.set()
+        self.loop.call_soon(run)
+        done.wait()
+        return result[0] if result else None
+
+    # Connection
+
+    def connect(self, port = None, baud = None):
+        """Set port and baudrate if given, then connect to printer"""
+        if self.printer:
+            self.disconnect()
+        if port is not None:
+            self.port = port
+        if baud is not None:
+            self.baud = baud
+        if self.port is None or self.baud is None:
+            return
+        self.writefailures = 0
+        started = self.connect_started = monotonic()
+        stats = self.connect_stats = {"open": None, "hup": None, "first_reply": None,
+                                      "online": None, "probes": 0}
+        address = tcp_address(self.port)
+        if address is not None:
+            host, tcp_port = address
+            self.printer_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.printer_tcp.settimeout(1.0)
+            try:
+                self.printer_tcp.connect(address)
+            except socket.error as e:
+                self.logError(_("Could not connect to %s:%s:") % (host, tcp_port) +
+                              "\n" + _("Socket error %s:") % e.errno +
+                              "\n" + decode_utf8(str(e.strerror)))
+                self.printer_tcp = None
+                return
+            # Writes are whole rounds of lines already, send them as they are
+            self.printer_tcp.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.printer_tcp.setblocking(False)
+            self.printer = self.printer_tcp
+            self.fd = self.printer_tcp.fileno()
+            stats["open"] = monotonic() - started
+        else:
+            self.printer_tcp = None
+            try:
+                self.printer = Serial(port = self.port, baudrate = self.baud, timeout = 0)
+            except (SerialException, IOError) as e:
+                self.logError(_("Could not connect to %s at baudrate %s:") % (self.port, self.baud) +
+                              "\n" + _("Serial error: %s") % e)
+                self.printer = None
+                return
+            self.fd = self.printer.fileno()
+            set_nonblocking(self.fd)
+            stats["open"] = monotonic() - started
+            # So closing the port does not reset the board next time
+            disable_hup(self.fd)
+            stats["hup"] = monotonic() - started - stats["open"]
+        self._call(self._attach)
+
+    def _attach(self):
+        if self.recorder:
+            self.recorder.connected(TCP if self.printer_tcp else SERIAL)
+        self.splitter.clear()
+        del self.outbuf[:]
+        self.writing = False
+        self._reset_inflight()
+        self.clear = True
+        self.loop.add_reader(self.fd, self._readable)
+        self.probe_wait = self.probe_initial
+        # A board that was up before the port was opened may have greeted
+        # already. It is online then without a probe, whose answer could
+        # otherwise be taken for that of the first line sent after.
+        if select.select([self.fd], [], [], 0)[0]:
+            self._readable()
+        self._probe()
+
+    def _probe(self):
+        """Ask for a temperature until the printer answers"""
+        self.probe = None
+        if self.online or not self.printer:
+            return
+        if self.writefailures >= 4:
+            print _("Aborting connection attempt after 4 failed writes.")
+            return
+        self._write("M105", "M105\n")
+        self._flush()
+        self.connect_stats["probes"] += 1
+        self.probe = self.loop.call_later(self.probe_wait, self._probe)
+        self.probe_wait = min(2 * self.probe_wait, self.probe_interval)
+
+    def connect_summary(self):
+        """Where the time of the last connect went, in words, or None if
+        it has not come online"""
+        stats = self.connect_stats
+        if stats.get("online") is None:
+            return None
+        parts = [_("port open in %.1f ms") % (1000 * stats["open"])]
+        if stats["hup"] is not None:
+            parts.append(_("HUPCL cleared in %.1f ms") % (1000 * stats["hup"]))
+        if stats["first_reply"] is not None:
+            parts.append(_("first reply after %.2f s") % stats["first_reply"])
+        parts.append(_("probes sent: %d") % stats["probes"])
+        return _("Online after %.2f s: ") % stats["online"] + ", ".join(parts)
+
+    def start_recording(self, path):
+        """Record everything written to and read from the printer into
+        path until stop_recording, to be played back by
+        testtools/replay.py"""
+        self._call(self._start_recording, path)
+
+    def _start_recording(self, path):
+        self._stop_recording()
+        self.recorder = SessionRecorder(path)
+        if self.printer:
+            self.recorder.connected(TCP if self.printer_tcp else SERIAL, self.online)
+
+    def stop_recording(self):
+        self._call(self._stop_recording)
+
+    def _stop_recording(self):
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+    def disconnect(self):
+        """Disconnects from printer and pauses the print"""
+        self._call(self._detach)
+
+    def _detach(self):
+        if self.probe:
+            self.probe.cancel()
+            self.probe = None
+        if self.printer:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+            try:
+                self.printer.close()
+            except (socket.error, OSError):
+                pass
+        self.printer = None
+        self.printer_tcp = None
+        self.fd = None
+        self.online = False
+        self.printing = False
+        self.held = None
+        self._stop_draining()
+
+    def reset(self):
+        """Reset the printer"""
+        if self.printer and not self.printer_tcp:
+            self.printer.setDTR(1)
+            self.loop.call_later(0.2, self.printer.setDTR, 0)
+
+    # Reading
+
+    def _readable(self):
+        try:
+            if self.printer_tcp:
+                data = self.printer_tcp.recv(4096)
+            else:
+                data = os.read(self.fd, 4096)
+        except (OSError, socket.error) as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            self.logError(_(u"Can't read from printer (disconnected?) (OS Error {0}): {1}").format(e.errno, decode_utf8(str(e.strerror))))
+            self._detach()
+            return
+        if not data:
+            self.logError(_(u"Can't read from printer (disconnected?)"))
+            self._detach()
+            return
+        if self.recorder:
+            self.recorder.received(data)
+        for line in self.splitter.feed(data):
+            self._receive(line)
+            if not self.printer:
+                return
+        self._pump()
+
+    def _receive(self, line):
+        if len(line) > 1:
+            self.log.append(line)
+            self.events.publish("recv", line)
+            if self.loud: logging.info("RECV: %s" % line.rstrip())
+        if not self.online:
+            stats = self.connect_stats
+            if line.strip() and stats.get("first_reply") is None and self.connect_started is not None:
+                stats["first_reply"] = monotonic() - self.connect_started
+            if line.startswith(tuple(self.greetings)) \
+               or line.startswith('ok') or "T:" in line:
+                if self.probe:
+                    self.probe.cancel()
+                    self.probe = None
+                # Probes sent while the board was booting are never
+                # answered, so start counting oks afresh
+                self._reset_inflight()
+                if self.connect_started is not None:
+                    stats["online"] = monotonic() - self.connect_started
+                    logging.info(self.connect_summary())
+                self.online = True
+                self.events.publish("online")
+            return
+        if line.startswith('DEBUG_'):
+            return
+        if line.startswith(tuple(self.greetings)):
+            self._reset_inflight()
+            self.clear = True
+        elif line.startswith('ok'):
+            if self._acknowledge():
+                self.clear = True
+            if self.draining:
+                self._drain_later()
+        if line.startswith('ok') and "T:" in line:
+            self.events.publish("temp", line)
+        elif line.startswith('Error'):
+            self.logError(line)
+        # Teststrings for resend parsing       # Firmware     exp. result
+        # line="rs N2 Expected checksum 67"    # Teacup       2
+        if line.lower().startswith("resend") or line.startswith("rs"):
+            for haystack in ["N:", "N", ":"]:
+                line = line.replace(haystack, " ")
+            for word in line.split():
+                try:
+                    toresend = int(word)
+                except ValueError:
+                    continue
+                if self.window and not self.printer_tcp:
+                    # Every line sent after the bad one is rejected too,
+                    # each with its own resend request; only the first
+                    # one counts
+                    if not self.draining:
+                        if self.inflight:
+                            self.draining = True
+                            self._drain_later()
+                        self.resendfrom = toresend
+                else:
+                    self.resendfrom = toresend
+                break
+            # Marlin, Sprinter and Repetier follow "Resend:" with an ok,
+            # which lets the resent line go; letting it go here as well
+            # would leave the firmware two lines to answer
+            if not line.lower().startswith("resend"):
+                self.clear = True
+
+    def _reset_inflight(self):
+        self.inflight.clear()
+        self.inflight_bytes = 0
+        self._stop_draining()
+
+    def _stop_draining(self):
+        self.draining = False
+        if self.drain_timer:
+            self.drain_timer.cancel()
+            self.drain_timer = None
+
+    def _drain_later(self):
+        """Give up draining drain_timeout from now"""
+        if self.drain_timer:
+            self.drain_timer.cancel()
+        self.drain_timer = self.loop.call_later(self.drain_timeout, self._drain_expired)
+
+    def _drain_expired(self):
+        self.drain_timer = None
+        if not self.draining or not self.printer:
+            return
+        # What is still in flight was thrown away with the firmware's
+        # receive buffer. An ok that still turns up for one of those lines
+        # is taken for a resent line's, which can only overfill the buffer
+        # and lead to another resend.
+        self._reset_inflight()
+        self._pump()
+
+    def _acknowledge(self):
+        """Take the oldest line in flight as answered. Returns whether the
+        ok lets the next line go: that of an emergency line does not, as
+        the line it jumped ahead of is still waiting for its own."""
+        try:
+            length, ack, emergency = self.inflight.popleft()
+        except IndexError:
+            return True
+        self.inflight_bytes -= length
+        if ack is not None:
+            ack.acked = monotonic()
+            ack.event.set()
+            if ack.callback:
+                self.events.call(ack.callback, ack)
+        return not emergency
+
+    # Sending
+
+    def send(self, command, wait = 0):
+        """Adds a command to the checksummed main command queue if printing, or
+        sends the command immediately if not printing"""
+        if self.online:
+            if self.printing:
+                self.mainqueue.append(command)
+            else:
+                self.priqueue.put_nowait((self.priority(command), (command, None)))
+            self.loop.call_soon(self._pump)
+
+    def priority(self, command):
+        """The priority send_now gives command when not told one"""
+        return command_priority(command, self.emergency_commands, self.status_commands)
+
+    def send_now(self, command, wait = 0, ack = None, priority = None):
+        """Sends a command to the printer ahead of the command queue, without a
+        checksum. Pass an Ack to find out when the printer answers it.
+        Commands go out by priority, see priority(); EMERGENCY ones are
+        written as soon as the loop gets to them, whether the printer is
+        clear or not."""
+        self.send_now_many([(command, ack)], priority)
+
+    def send_now_many(self, commands, priority = None):
+        """send_now for several commands at once, so that they go out in
+        one write. commands holds commands and (command, Ack) pairs. They
+        all go at the priority of the most urgent one."""
+        if not self.online:
+            return
+        items = [c if isinstance(c, tuple) else (c, None) for c in commands]
+        if not items:
+            return
+        if priority is None:
+            priority = min(self.priority(command) for command, ack in items)
+        if priority == EMERGENCY:
+            self.loop.call_soon(self._emergency, items, monotonic())
+            return
+        self.priqueue.put_many(priority, items)
+        self.loop.call_soon(self._pump)
+
+    def _emergency(self, items, called):
+        if not self.printer:
+            return
+        for command, ack in items:
+            self._write(command, str(command + "\n"), ack, emergency = True)
+        self._flush()
+        self._hand_off()
+        waited = monotonic() - called
+        for item in items:
+            self.priqueue.count(EMERGENCY, waited)
+
+    def queue_stats(self):
+        """See CommandQueue.stats"""
+        return self.priqueue.stats()
+
+    def startprint(self, gcode, startindex = 0):
+        """Start a print, gcode is an array of gcode commands.
+        returns True on success, False if already printing.
+        The job is compiled on a thread of its own, then printed from the
+        loop."""
+        if self.printing or not self.online or not self.printer:
+            return False
+        return self._call(self._startprint, gcode, startindex)
+
+    def _startprint(self, gcode, startindex):
+        if self.printing or not self.online or not self.printer:
+            return False
+        job = self.compiled
+        if (job is None or job.gcode is not gcode or job.checksums == bool(self.printer_tcp)
+                or startindex < job.first or self.preprintsendcb):
+            job = None
+        self.printing = True
+        self.paused = False
+        self.completed = False
+        self.mainqueue = gcode
+        self.compiled = None
+        self.queueindex = startindex
+        self.resendfrom = -1
+        self.sentlines = SentLines(max(self.resend_history, self.window))
+        self.clear = False
+        self.compiling = token = object()
+        thread = Thread(target = self._compile, args = (token, gcode, startindex, job))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _compile(self, token, gcode, startindex, job):
+        try:
+            if job is None and not self.preprintsendcb:
+                job = CompiledJob(gcode, startindex, checksums = not self.printer_tcp)
+        except:
+            self.logError(_("Print thread died due to the following error:") +
+                          "\n" + traceback.format_exc())
+            job = None
+        self.loop.call_soon(self._begin, token, job, startindex != 0)
+
+    def _begin(self, token, job, resuming):
+        if self.compiling is not token:
+            # Stopped or restarted meanwhile
+            return
+        self.compiling = None
+        if not self.printing or not self.printer:
+            return
+        gcode = self.mainqueue
+        self.compiled = job
+        self.lineno = job.lineno_at(self.queueindex) if job else 0
+        self.events.publish("start", resuming)
+        self._send("M110", self.lineno - 1, True)
+        self.clear = False
+        if not gcode.lines:
+            self.printing = False
+            self.clear = True
+        self._pump()
+
+    def pause(self):
+        """Stop feeding the print, the lines in flight still go through"""
+        self._call(self._pause)
+
+    def _pause(self):
+        if self.printing:
+            self.paused = True
+            self.printing = False
+            self.compiling = None
+
+    def resume(self):
+        """Carry on with a paused print, the line numbers carry on too"""
+        self._call(self._resume)
+
+    def _resume(self):
+        if self.paused and self.online and self.mainqueue is not None:
+            self.paused = False
+            self.printing = True
+            if self.compiled is None and not self.preprintsendcb:
+                # Paused before it was compiled, start it over from here
+                self.printing = False
+                self._startprint(self.mainqueue, self.queueindex)
+            else:
+                self._pump()
+
+    def processHostCommand(self, command):
+        command = command.lstrip()
+        if command.startswith(";@pause"):
+            if self.pronterface is not None:
+                self.pronterface.pause(None)
+            else:
+                self.pause()
+
+    def _pump(self):
+        """Write whatever the printer can take now"""
+        lines = 0
+        while self.printer and self.online and not self.writing:
+            if lines == self.round_lines:
+                self.loop.call_soon(self._pump)
+                break
+            if self.held is None:
+                self.held = self._next()
+                if self.held is None:
+                    break
+            command, line, ack = self.held
+            if (self.window and self.printing and not self.printer_tcp and self.inflight
+                    and self.inflight_bytes + len(line) > self.window):
+                break
+            self.held = None
+            self._write(command, line, ack)
+            lines += 1
+            if len(self.outbuf) >= self.chunk:
+                self._flush()
+        self._flush()
+        self._hand_off()
+
+    def _next(self):
+        """The next (command, line, ack) to write, or None when nothing can
+        go now. Anything that is not a line (host commands, comments) is
+        dealt with on the way."""
+        while self.printing:
+            if self.compiling:
+                return None
+            if self.window and not self.printer_tcp:
+                if self.draining:
+                    if self.inflight:
+                        return None
+                    self._stop_draining()
+            elif not self.clear and not self.printer_tcp:
+                return None
+            if -1 < self.resendfrom < self.lineno:
+                try:
+                    command = self.sentlines[self.resendfrom]
+                except ResendOverflow as e:
+                    self.logError(unicode(e) + "\n" + _("Print stopped."))
+                    self.printing = False
+                    self.clear = True
+                    self._ended()
+                    return None
+                self.resendfrom += 1
+                return self._take(command, str(command + "\n"))
+            self.resendfrom = -1
+            if not self.priqueue.empty():
+                command, ack = self.priqueue.get_nowait()
+                self.priqueue.task_done()
+                return self._take(command, str(command + "\n"), ack)
+            job = self.compiled
+            if job and job.first <= self.queueindex < job.count:
+                item = self._nextcompiled(job)
+            elif self.queueindex < len(self.mainqueue):
+                item = self._nextline()
+            elif self.inflight:
+                # Not done until the firmware has taken every line, it can
+                # still ask for some of them again
+                return None
+            else:
+                self._finish()
+                continue
+            if item is not None:
+                return item
+        if not self.priqueue.empty():
+            command, ack = self.priqueue.get_nowait()
+            self.priqueue.task_done()
+            return command, str(command + "\n"), ack
+        return None
+
+    def _take(self, command, line, ack = None):
+        """A line of the print is going, wait for its ok when not streaming"""
+        self.clear = False
+        return command, line, ack
+
+    def _nextcompiled(self, job):
+        index = self.queueindex
+        if index in job.layers:
+            self.events.publish("layerchange", job.layers[index])
+        self.queueindex += 1
+        host = job.hosts.get(index)
+        if host is not None:
+            self.processHostCommand(host)
+            return None
+        k = index - job.first
+        lineno = job.linenos[k]
+        if lineno < 0:
+            return None
+        line = job.data[job.starts[k]:job.starts[k + 1]]
+        command = line[:-1]
+        if job.checksums:
+            self.sentlines[lineno] = command
+        self.lineno = lineno + 1
+        self.events.publish("printsend", job.gcode.lines[index])
+        return self._take(command, line)
+
+    def _nextline(self):
+        index = self.queueindex
+        (layer, line) = self.mainqueue.idxs(index)
+        gline = self.mainqueue.all_layers[layer][line]
+        if index > 0 and self.mainqueue.idxs(index - 1)[0] != layer:
+            self.events.publish("layerchange", layer)
+        self.queueindex += 1
+        if self.preprintsendcb:
+            if index + 1 < len(self.mainqueue):
+                (next_layer, next_line) = self.mainqueue.idxs(index + 1)
+                next_gline = self.mainqueue.all_layers[next_layer][next_line]
+            else:
+                next_gline = None
+            gline = self.preprintsendcb(gline, next_gline)
+        if gline is None:
+            return None
+        tline = gline.raw
+        if tline.lstrip().startswith(";@"):
+            self.processHostCommand(tline)
+            return None
+        tline = tline.split(";")[0]
+        if not tline:
+            return None
+        command = self._number(tline, self.lineno)
+        self.lineno += 1
+        self.events.publish("printsend", gline)
+        return self._take(command, str(command + "\n"))
+
+    def _number(self, command, lineno):
+        if self.printer_tcp:
+            return command
+        prefix = "N" + str(lineno) + " " + command
+        command = prefix + "*" + str(self._checksum(prefix))
+        if "M110" not in command:
+            self.sentlines[lineno] = command
+        return command
+
+    def _send(self, command, lineno = 0, calcchecksum = False, ack = None):
+        if calcchecksum:
+            command = self._number(command, lineno)
+        self._write(command, str(command + "\n"), ack)
+
+    def _finish(self):
+        self.printing = False
+        self.clear = True
+        if not self.paused:
+            self.completed = True
+            self.queueindex = 0
+            self.lineno = 0
+            self.compiled = None
+            self._send("M110", -1, True)
+        self._ended()
+
+    def _ended(self):
+        self.sentlines.clear()
+        self.log.clear()
+        self.sent.clear()
+        self.events.publish("end")
+
+    def _write(self, command, line, ack = None, emergency = False):
+        """Queue line, command and its newline, to be written at the end
+        of this round"""
+        self.sent.append(command)
+        if self.analyze or self.loud or self.events.subscribed("send"):
+            self.unanalyzed.append(command)
+        length = len(line)
+        if ack is not None:
+            ack.sent = monotonic()
+        self.inflight.append((length, ack, emergency))
+        self.inflight_bytes += length
+        self.outbuf += line
+
+    def _flush(self):
+        if not self.outbuf or not self.printer:
+            return
+        try:
+            if self.printer_tcp:
+                written = self.printer_tcp.send(self.outbuf)
+            else:
+                written = os.write(self.fd, self.outbuf)
+            self.writefailures = 0
+        except (OSError, socket.error) as e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                self.logError(_(u"Can't write to printer (disconnected?) (OS Error {0}): {1}").format(e.errno, decode_utf8(str(e.strerror))))
+                self.writefailures += 1
+                del self.outbuf[:]
+                return
+            written = 0
+        if self.recorder and written:
+            self.recorder.sent(self.outbuf[:written])
+        del self.outbuf[:written]
+        if self.outbuf and not self.writing:
+            self.writing = True
+            self.loop.add_writer(self.fd, self._writable)
+
+    def _writable(self):
+        self._flush()
+        if not self.outbuf:
+            self.writing = False
+            self.loop.remove_writer(self.fd)
+            self._pump()
+
+    def _hand_off(self):
+        """Have the bus thread analyze what this round wrote"""
+        if self.unanalyzed and not self.analyzing:
+            self.analyzing = True
+            self.events.call(self._analyze)
+
+    def _analyze(self):
+        """Run what was written through the analyzer, then log it and
+        publish it to sendcb, from the bus thread"""
+        # Cleared first, lines written from now on get another call
+        self.analyzing = False
+        while self.unanalyzed:
+            command = self.unanalyzed.popleft()
+            gline = None
+            if self.analyze:
+                try:
+                    with self.analyzer_lock:
+                        gline = self.analyzer.append(command, store = False)
+                except:
+                    logging.warning(_("Could not analyze command %s:") % command +
+                                    "\n" + traceback.format_exc())
+            if self.loud:
+                logging.info("SENT: %s" % command)
+            self.events.publish("send", command, gline)
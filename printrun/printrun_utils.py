@@ -21,6 +21,9 @@ import datetime
 import subprocess
 import shlex
 import logging
+import time
+import ctypes
+import ctypes.util
 
 # Set up Internationalization using gettext
 # searching for installed locales on /usr/share; uses relative folder if not
@@ -89,6 +92,34 @@ def decode_utf8(s):
         pass
     return s
 
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+def _clock_gettime():
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1", use_errno = True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        ts = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+# Seconds from an arbitrary origin, unaffected by wall clock changes (NTP
+# stepping the clock on a Pi while a print is running, for instance)
+monotonic = getattr(time, "monotonic", None)
+if monotonic is None and sys.platform.startswith("linux"):
+    monotonic = _clock_gettime()
+if monotonic is None:
+    monotonic = time.time
+
 def format_time(timestamp):
     return datetime.datetime.fromtimestamp(timestamp).strftime("%H:%M:%S")
 
@@ -19,12 +19,14 @@ import wx.lib.agw.floatspin as floatspin
 import os
 import sys
 import time
+import threading
 import zipfile
 import tempfile
 import shutil
 import cairosvg
 import cairosvg.surface
 from cairosvg.surface import PNGSurface
+from cairosvg.parser import Tree
 import cStringIO
 import imghdr
 import copy
@@ -32,6 +34,42 @@ import re
 from collections import OrderedDict
 import itertools
 import math 
+import numpy
+from printrun import raster
+from printrun import rasterizer
+from printrun.layercache import LayerCache
+from printrun.layerpipeline import LayerPipeline
+from printrun.svgslices import SliceFile
+from printrun.layerarchive import LayerArchive
+from printrun.exposure import ExposureScheduler, direct
+from printrun.display import DisplayBackend, FramebufferBackend
+from printrun.printrun_utils import monotonic
+from printrun.telemetry import JobTelemetry
+from printrun.printcore import Ack
+
+class WxBackend(DisplayBackend):
+    """Shows frames in the StaticBitmap of a DisplayFrame"""
+
+    gui = True
+
+    def __init__(self, window):
+        self.window = window
+
+    def show(self, frame, changed=True):
+        window = self.window
+        if changed:
+            # Copy the composed frame into the bitmap in one go; older wx
+            # without CopyFromBuffer gets a new bitmap made from the buffer
+            if hasattr(window.bitmap, 'CopyFromBuffer'):
+                window.bitmap.CopyFromBuffer(frame.pixels)
+            else:
+                window.bitmap = wx.BitmapFromBuffer(frame.width, frame.height, frame.pixels)
+            window.pic.SetBitmap(window.bitmap)
+        window.pic.Show()
+        window.Refresh()
+
+    def blank(self):
+        self.window.pic.Hide()
 
 class DisplayFrame(wx.Frame):
     def __init__(self, parent, title, res=(1024, 768), printer=None, scale=1.0, offset=(0,0)):
@@ -41,6 +79,7 @@ class DisplayFrame(wx.Frame):
         self.pic = wx.StaticBitmap(self)
         self.bitmap = wx.EmptyBitmap(*res)
         self.bbitmap = wx.EmptyBitmap(*res)
+        self.frame = raster.FrameBuffer(*res)
         self.slicer = 'bitmap'
         self.dpi = 96
         dc = wx.MemoryDC()
@@ -60,19 +99,40 @@ class DisplayFrame(wx.Frame):
         self.offset = offset
         self.running = False
         self.layer_red = False
+        self.cache = None
+        self.pipeline = None
+        self.scheduler = None
+        self.telemetry = None
+        self.telemetry_dir = ''
+        self.job_name = 'job'
+        self.lookahead = 3
+        self.render_workers = 1
+        self.renderer = 'cairosvg'
+        self.antialias = rasterizer.cairo_rows
+        self.lift_sync = 'ok'
+        self.lift_synced = False
+        self.settle = 0.5
+        self.lift_timeout_s = 30.0
+        # Recently rendered layers by geometry digest, shared between
+        # identical layers
+        self.shared = OrderedDict()
+        self.shared_lock = threading.Lock()
+        self.shown_digest = None
+        self.backend = WxBackend(self)
 
     def repos(self,x,y):
         self.SetPosition((x,y))
 
+    def set_backend(self, backend):
+        if self.backend is not backend:
+            self.backend.close()
+        self.backend = backend
+        self.shown_digest = None
+
     def clear_layer(self):
         try:
-            dc = wx.MemoryDC()
-            dc.SelectObject(self.bitmap)
-            dc.SetBackground(wx.Brush("black"))
-            dc.Clear()
-            self.pic.SetBitmap(self.bitmap)
-            self.pic.Show()
-            self.Refresh()
+            self.frame.clear()
+            self.show_frame()
         except:
             raise
             pass
@@ -80,78 +140,109 @@ class DisplayFrame(wx.Frame):
     def resize(self, res=(1024, 768)):
         self.bitmap = wx.EmptyBitmap(*res)
         self.bbitmap = wx.EmptyBitmap(*res)
+        self.frame = raster.FrameBuffer(*res)
+        self.shown_digest = None
         dc = wx.MemoryDC()
         dc.SelectObject(self.bbitmap)
         dc.SetBackground(wx.Brush("black"))
         dc.Clear()
         dc.SelectObject(wx.NullBitmap)
         
+    def layer_renderer(self, image):
+        if self.renderer == 'numpy' and self.slicer == 'Slic3r' and rasterizer.supported(image.data()):
+            return 'numpy'
+        return 'cairosvg'
+
+    def render_layer(self, image):
+        with self.shared_lock:
+            layer = self.shared.pop(image.digest, None)
+            if layer is not None:
+                self.shared[image.digest] = layer
+                return layer
+        layer = self.render_unique(image)
+        with self.shared_lock:
+            self.shared[image.digest] = layer
+            # Enough to cover the layers the pipeline renders ahead
+            while len(self.shared) > self.lookahead + 2:
+                self.shared.popitem(last=False)
+        return layer
+
+    def render_unique(self, image):
+        if self.slicer == 'archive':
+            # Already rasterized, only needs decoding
+            return image.raster()
+        renderer = self.layer_renderer(image)
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(image.identity(), self.dpi, self.scale, self.size,
+                                 "%s-%d" % (renderer, self.antialias) if renderer == 'numpy' else renderer)
+            layer = self.cache.get(key)
+            if layer is not None:
+                return layer
+        if renderer == 'numpy':
+            source = image.source
+            layer = rasterizer.rasterize(image.data(), source.width, source.height, self.dpi,
+                                         scale=self.scale, supersample=self.antialias)
+        else:
+            # Read the pixels straight off cairosvg's cairo surface, rather
+            # than having it encode a PNG for us to decode again
+            surface = PNGSurface(Tree(bytestring=image.svg(self.scale)), None, self.dpi)
+            layer = raster.from_cairo(surface.cairo)
+        if key is not None:
+            self.cache.put(key, layer)
+        return layer
+
+    def show_frame(self, changed=True):
+        if changed:
+            self.shown_digest = None
+        self.backend.show(self.frame, changed)
+
     def draw_layer(self, image):
         try:
-            dc = wx.MemoryDC()
-            dc.SelectObject(self.bitmap)
-            dc.SetBackground(wx.Brush("black"))
-            dc.Clear()
-
-            if self.slicer == 'Slic3r' or self.slicer == 'Skeinforge':
-                
-                if self.scale != 1.0:
-                    layercopy = copy.deepcopy(image)
-                    height = float(layercopy.get('height').replace('m',''))
-                    width = float(layercopy.get('width').replace('m',''))
-                    
-                    layercopy.set('height', str(height*self.scale) + 'mm')
-                    layercopy.set('width', str(width*self.scale) + 'mm')
-                    layercopy.set('viewBox', '0 0 ' + str(width*self.scale) + ' ' + str(height*self.scale))
-
-                    g = layercopy.find("{http://www.w3.org/2000/svg}g")
-                    g.set('transform', 'scale('+str(self.scale)+')')
-                    stream = cStringIO.StringIO(PNGSurface.convert(dpi=self.dpi, bytestring=xml.etree.ElementTree.tostring(layercopy)))
-                else:
-                    stream = cStringIO.StringIO(PNGSurface.convert(dpi=self.dpi, bytestring=xml.etree.ElementTree.tostring(image)))
-                    pngImage = wx.ImageFromStream(stream)
-                if self.layer_red:
-                    pngImage = pngImage.AdjustChannels(1,0,0,1)
-                dc.DrawBitmap(wx.BitmapFromImage(pngImage), self.offset[0], self.offset[1], True)
+            self.frame.clear()
+
+            if isinstance(image, raster.Raster):
+                self.frame.blit(image.array(), self.offset[0], self.offset[1], self.layer_red)
+
+            elif self.slicer in ('Slic3r', 'Skeinforge', 'archive'):
+                layer = self.render_layer(image)
+                self.frame.blit(layer.array(), self.offset[0], self.offset[1], self.layer_red)
 
             elif self.slicer == 'bitmap':
                 if isinstance(image, str):
                     image = wx.Image(image)
-                if self.layer_red:
-                    image = image.AdjustChannels(1,0,0,1)
-                dc.DrawBitmap(wx.BitmapFromImage(image.Scale(image.Width * self.scale, image.Height * self.scale)), self.offset[0], -self.offset[1], True)
+                # A view on the wx.Image's own pixels, no copy
+                pixels = numpy.frombuffer(image.GetDataBuffer(), numpy.uint8).reshape(image.Height, image.Width, 3)
+                self.frame.blit(pixels, self.offset[0], -self.offset[1], self.layer_red, self.scale)
 
             else:
                 raise Exception(self.slicer + " is an unknown method.")
             
-            self.pic.SetBitmap(self.bitmap)
-            self.pic.Show()
-            self.Refresh()            
+            self.show_frame()
             
         except:
             raise
             pass
             
-    def show_img_delay(self, image):
-        if self.ended:
-            return
-        self.draw_layer(image)
-        # Show first layer fl_time seconds long
-        if (self.index==1):
-            wx.FutureCall(2000 + 1000 * self.fl_time, self.hide_pic_and_rise)
-            print "Primera capa a " + str(self.fl_time) + "."
-            wx.FutureCall(2000 , self.servo_open)
-        else:
-            wx.FutureCall(1000 * self.interval, self.hide_pic_and_rise)
+    def call_in_gui(self, fn, *args):
+        """Run fn on the wx thread, wait for it and return when it ran"""
+        done = threading.Event()
+        ran = []
+        def run():
+            try:
+                fn(*args)
+            finally:
+                ran.append(monotonic())
+                done.set()
+        wx.CallAfter(run)
+        done.wait()
+        return ran[0]
 
     def go_home(self):
-    	self.printer.send_now("M210 Z160")
-    	self.printer.send_now("G28")
+        self.printer.send_now_many(["M210 Z160", "G28"])
 
     def go_top(self):
-        self.printer.send_now("G90")
-    	self.printer.send_now("M210 Z160")
-    	self.printer.send_now("G0 Z200")
+        self.printer.send_now_many(["G90", "M210 Z160", "G0 Z200"])
 
     def servo_open(self):
         self.printer.send_now("G93")
@@ -160,33 +251,44 @@ class DisplayFrame(wx.Frame):
         self.printer.send_now("G94")
         
  
-    def rise(self):
+    def rise(self, index):
+        """Lift to the next layer. Returns the Ack the layer cycle should
+        wait for before settling, or None to fall back on fixed pauses"""
+        self.lift_synced = False
         if self.ended:
-            return
+            return None
         if self.printer != None and self.printer.online and not self.ended:
-            self.printer.send_now("G91")
-            
-            if (not self.ended):
-                if (self.index==1):
-                    self.printer.send_now("G2 O%f L%f" % (self.overshoot*3,self.thickness,))
-                else:
-                    self.printer.send_now("G2 O%f L%f" % (self.overshoot,self.thickness,))
-            self.printer.send_now("G90")
+            ack = Ack(lambda ack: self.telemetry.record(index, 'lift_ack', ack.latency()))
+            thickness = self.layer_thickness(index + 1)
+            if (index==0):
+                lift = "G2 O%f L%f" % (self.overshoot*3,thickness,)
+            else:
+                lift = "G2 O%f L%f" % (self.overshoot,thickness,)
+            # One write for the whole lift
+            commands = ["G91", (lift, ack), "G90"]
+            if self.lift_sync == 'M400':
+                # Answered once the printer has finished all its moves
+                ack = Ack()
+                commands.append(("M400", ack))
+            self.printer.send_now_many(commands)
+            if self.lift_sync not in ('ok', 'M400'):
+                return None
+            self.lift_synced = True
+            return ack
         else:
             time.sleep(self.pause)
+        return None
         
-        if (self.index==1):
-            # primera capa
-            wx.FutureCall(1000 * self.pause * 3, self.next_img)
-        else:
-            wx.FutureCall(1000 * self.pause, self.next_img)
-        
+    def layer_thickness(self, index):
+        # Layer archives record the height of every layer
+        if index < len(self.layers):
+            thickness = getattr(self.layers[index], 'thickness', None)
+            if thickness:
+                return thickness
+        return self.thickness
+
     def hide_pic(self):
-        self.pic.Hide()
-        
-    def hide_pic_and_rise(self):
-        wx.CallAfter(self.hide_pic)
-        wx.FutureCall(500, self.rise)
+        self.backend.blank()
 
     def layer_counter(self):
         ns=len(str(len(self.layers)))-len(str(self.index))
@@ -199,26 +301,102 @@ class DisplayFrame(wx.Frame):
           timeS = (len(self.layers) - self.index) * (float(self.interval) + float(self.pause) + 0.5)
         self.l.put_line1("Tiempo: " + time.strftime("%H:%M:%S",time.gmtime(timeS)))
         self.l.put_line2(s[:ns] + str(self.index) + "/" + str(len(self.layers)) + "  " + percent + "%")
-                    
-    def next_img(self):
-        if not self.running:
-            return
-        if self.ended:
+
+    # Layer cycle, driven by ExposureScheduler from its own thread
+
+    def render_index(self, index):
+        start = monotonic()
+        layer = self.render_layer(self.layers[index])
+        self.telemetry.record(index, 'render', monotonic() - start)
+        return layer
+
+    def prepare(self, index):
+        if self.pipeline:
+            return self.pipeline.get(index)
+        if self.slicer in ('Slic3r', 'Skeinforge', 'archive'):
+            return self.render_index(index)
+        return self.layers[index]
+
+    def expose(self, index, layer):
+        if not self.running or self.ended:
             return
-        if self.index < len(self.layers):
-            self.layer_counter()
-            wx.CallAfter(self.show_img_delay, self.layers[self.index])
-            self.index += 1
+        start = monotonic()
+        digest = getattr(self.layers[index], 'digest', None)
+        if digest is not None and digest == self.shown_digest:
+            # Identical to the layer still in the frame, just show it again
+            self.show_frame(changed=False)
         else:
-            # Last layer
-            self.l.put_lines("    Impresion","   finalizada")
-            print "End"
-            self.go_top()
-            self.ended=True
-            self.servo_close()
-            wx.CallAfter(self.pic.Hide)
-            wx.CallAfter(self.Refresh)
-            sys.exit()
+            self.draw_layer(layer)
+            self.shown_digest = digest
+        self.telemetry.record(index, 'show', monotonic() - start)
+
+    def progress(self, index):
+        self.index = index + 1
+        self.layer_counter()
+
+    def shutter_delay(self, index):
+        # The first layer is put on screen before the shutter opens
+        return 2.0 if index == 0 else 0
+
+    def open_shutter(self, index):
+        print "Primera capa a " + str(self.fl_time) + "."
+        self.servo_open()
+
+    def exposure_time(self, index):
+        # Layer archives can carry their own exposure per layer
+        exposure = getattr(self.layers[index], 'exposure', None)
+        if exposure is not None:
+            return exposure
+        return self.fl_time if index == 0 else self.interval
+
+    def hide(self, index):
+        self.hide_pic()
+
+    def lift_delay(self, index):
+        return 0.5
+
+    def lift(self, index):
+        return self.rise(index)
+
+    def lift_timeout(self, index):
+        return self.lift_timeout_s
+
+    def settle_time(self, index):
+        if self.lift_synced:
+            # Counted from when the printer acknowledged the lift
+            return self.settle
+        return self.pause * 3 if index == 0 else self.pause
+
+    def finish(self, completed):
+        records = self.scheduler.records
+        for record, following in zip(records, records[1:] + [None]):
+            self.telemetry.record(record["layer"], 'exposure', record["exposure"])
+            if following is not None:
+                self.telemetry.record(record["layer"], 'idle', following["on"] - record["off"])
+        print self.telemetry.format_summary()
+        if self.telemetry_dir:
+            self.telemetry.save(self.telemetry_dir)
+        report = self.scheduler.report()
+        print ("Exposure jitter over %d layers (p50/p95/max ms): on %.1f/%.1f/%.1f, "
+               "exposure %.1f/%.1f/%.1f, lift %.1f/%.1f/%.1f" % (
+                   (report["layers"],) +
+                   tuple(1000 * report[key][stat]
+                         for key in ("on_late", "exposure_error", "lift_late")
+                         for stat in ("p50", "p95", "max"))))
+        if completed:
+            wx.CallAfter(self.end_job)
+
+    def end_job(self):
+        # Last layer
+        self.l.put_lines("    Impresion","   finalizada")
+        print "End"
+        self.stop_pipeline()
+        self.go_top()
+        self.ended=True
+        self.servo_close()
+        self.hide_pic()
+        self.Refresh()
+        sys.exit()
         
     def present(self, 
                 layers, 
@@ -233,8 +411,11 @@ class DisplayFrame(wx.Frame):
                 layer_red=False):
         if self.ended:
             return
-        wx.CallAfter(self.pic.Hide)
-        wx.CallAfter(self.Refresh)
+        if self.backend.gui:
+            wx.CallAfter(self.hide_pic)
+            wx.CallAfter(self.Refresh)
+        else:
+            self.hide_pic()
         self.layers = layers
         self.scale = scale
         self.thickness = thickness
@@ -247,8 +428,38 @@ class DisplayFrame(wx.Frame):
         self.offset = offset
         self.index = 0
         self.running = True
-        
-        self.next_img()
+        self.telemetry = JobTelemetry(self.job_name)
+        with self.shared_lock:
+            self.shared.clear()
+        self.shown_digest = None
+
+        self.stop_pipeline()
+        if self.lookahead > 0 and self.slicer in ('Slic3r', 'Skeinforge', 'archive'):
+            self.pipeline = LayerPipeline(self.render_index,
+                                          len(layers),
+                                          depth=self.lookahead,
+                                          workers=self.render_workers)
+            self.pipeline.start()
+
+        if self.scheduler:
+            self.scheduler.stop()
+        # Only the wx backend has to be driven from the GUI thread
+        self.scheduler = ExposureScheduler(self, len(layers),
+                                           dispatch=self.call_in_gui if self.backend.gui else direct)
+        self.scheduler.start()
+
+    def stop(self):
+        self.running = False
+        if self.scheduler:
+            self.scheduler.stop()
+        self.stop_pipeline()
+
+    def stop_pipeline(self):
+        if self.pipeline:
+            self.pipeline.stop()
+            stats = self.pipeline.stats()
+            print "Render pipeline: waited for %(waits)d of %(layers)d layers, %(wait_time).2fs total, %(max_wait).2fs max" % stats
+            self.pipeline = None
 
 class SettingsFrame(wx.Frame):
     
@@ -282,6 +493,19 @@ class SettingsFrame(wx.Frame):
         self.projected_X_mm = self._get_setting("project_x_proyectada", 505.0)
         self.fl_time        = int(self._get_setting("project_primera_capa",20))
         self.z_axis_rate    = str(self._get_setting("project_velocidad_z", 200))
+        self.cache_dir      = self._get_setting("project_cache", "~/.printrun/layercache")
+        self.cache_mb       = int(self._get_setting("project_cache_mb", 256))
+        self.lookahead      = int(self._get_setting("project_lookahead", 3))
+        self.render_workers = int(self._get_setting("project_render_workers", 1))
+        self.renderer       = self._get_setting("project_renderer", "cairosvg")
+        self.antialias      = int(self._get_setting("project_antialias", rasterizer.cairo_rows))
+        self.telemetry_dir  = self._get_setting("project_telemetry", "~/.printrun/telemetry")
+        self.display        = self._get_setting("project_display", "wx")
+        self.lift_sync      = self._get_setting("project_lift_sync", "ok")
+        self.settle         = float(self._get_setting("project_settle", 0.5))
+        self.lift_timeout   = float(self._get_setting("project_lift_timeout", 30.0))
+        self.display_frame.cache = LayerCache(self.cache_dir) if self.cache_dir else None
+        self.setup_display()
         
         self.layer_red = False
 
@@ -302,51 +526,75 @@ class SettingsFrame(wx.Frame):
         self.projected_X_mm = self._get_setting("project_x_proyectada", 505.0)
         self.fl_time        = int(self._get_setting("project_primera_capa",20))
         self.z_axis_rate    = str(self._get_setting("project_velocidad_z", 200))
+        self.cache_dir      = self._get_setting("project_cache", "~/.printrun/layercache")
+        self.cache_mb       = int(self._get_setting("project_cache_mb", 256))
+        self.lookahead      = int(self._get_setting("project_lookahead", 3))
+        self.render_workers = int(self._get_setting("project_render_workers", 1))
+        self.renderer       = self._get_setting("project_renderer", "cairosvg")
+        self.antialias      = int(self._get_setting("project_antialias", rasterizer.cairo_rows))
+        self.telemetry_dir  = self._get_setting("project_telemetry", "~/.printrun/telemetry")
+        self.display        = self._get_setting("project_display", "wx")
+        self.lift_sync      = self._get_setting("project_lift_sync", "ok")
+        self.settle         = float(self._get_setting("project_settle", 0.5))
+        self.lift_timeout   = float(self._get_setting("project_lift_timeout", 30.0))
+        self.display_frame.cache = LayerCache(self.cache_dir) if self.cache_dir else None
+        self.setup_display()
+
+    def setup_display(self):
+        backend = self.display_frame.backend
+        if self.display == "wx":
+            if not isinstance(backend, WxBackend):
+                self.display_frame.set_backend(WxBackend(self.display_frame))
+            return
+        if isinstance(backend, FramebufferBackend) and backend.path == self.display:
+            return
+        try:
+            # The size is only used if the path is a plain file
+            backend = FramebufferBackend(self.display, size=(int(self.X), int(self.Y)))
+        except (IOError, OSError, ValueError) as e:
+            print "Could not open framebuffer %s, using a window: %s" % (self.display, e)
+            backend = WxBackend(self.display_frame)
+        self.display_frame.set_backend(backend)
 
     def parse_svg(self, name):
-        et = xml.etree.ElementTree.ElementTree(file=name)
-        #xml.etree.ElementTree.dump(et)
-        
-        slicer = 'Slic3r' if et.getroot().find('{http://www.w3.org/2000/svg}metadata') == None else 'Skeinforge'
-        zlast = 0
-        zdiff = 0
-        ol = []
-        height = et.getroot().get('height').replace('m','')
-        width = et.getroot().get('width').replace('m','')
+        slices = SliceFile(name)
 
         # Save this data to center the part
-        self.display_frame.part_h=height
-        self.display_frame.part_w=width
-            
-        for i in et.findall("{http://www.w3.org/2000/svg}g"):
-            z = float(i.get('{http://slic3r.org/namespaces/slic3r}z'))
-            zdiff = z - zlast
-            zlast = z
-
-            svgSnippet = xml.etree.ElementTree.Element('{http://www.w3.org/2000/svg}svg')
-            svgSnippet.set('height', height + 'mm')
-            svgSnippet.set('width', width + 'mm')
-
-            svgSnippet.set('viewBox', '0 0 ' + width + ' ' + height)
-            svgSnippet.set('style','background-color:black;fill:white;')
-            svgSnippet.append(i)
-    
-            ol += [svgSnippet]
-        return ol, zdiff, slicer
+        self.display_frame.part_h=slices.height
+        self.display_frame.part_w=slices.width
+
+        return slices, slices.zdiff, slices.slicer
     
+    def parse_archive(self, name):
+        archive = LayerArchive(name)
+        if archive.dpi and abs(archive.dpi - self.get_dpi()) > 0.01 * archive.dpi:
+            print "Layer archive made at %.1f dpi, the projector is set up for %.1f dpi" % (archive.dpi, self.get_dpi())
+        # Layers are centered by their size in pixels
+        self.display_frame.part_w = archive.width * 25.4 / self.get_dpi()
+        self.display_frame.part_h = archive.height * 25.4 / self.get_dpi()
+        return archive, archive.layer_height, 'archive'
+
     def load_file_this(self,path):
         print("Cargando pieza")
         name = path
+        ext = os.path.splitext(name)[1].lower()
         if not(os.path.exists(name)):
-            return "Falta el .svg"
+            # The extension fits on the display, the whole path may not
+            return "Falta el " + (ext or os.path.basename(name))
         else:
-            layers = self.parse_svg(name)
+            if ext == '.zip':
+                layers = self.parse_archive(name)
+            else:
+                layers = self.parse_svg(name)
             layerHeight = layers[1]
             self.thickness = str(layers[1])
             print "Layer thickness detected:", layerHeight, "mm"
             ret=("H:"+str(layerHeight)+" N:"+str(len(layers[0])))
         print len(layers[0]), "layers found, total height", layerHeight * len(layers[0]), "mm"
+        print "%d unique layers, %.1f%% deduplicated" % (layers[0].unique, 100 * layers[0].dedup_ratio())
         self.layers = layers
+        if self.display_frame.cache is not None:
+            self.display_frame.cache.prune(self.cache_mb * 1024 * 1024)
         self.current_filename = os.path.basename(name) 
         self.slicer = layers[2]
         self.display_frame.slicer = self.slicer
@@ -393,6 +641,10 @@ class SettingsFrame(wx.Frame):
         self.display_frame.draw_layer(gridBitmap.ConvertToImage())
 
     def update_fullscreen2(self):
+        backend = self.display_frame.backend
+        if not backend.gui:
+            self.display_frame.resize((backend.width, backend.height))
+            return
         self.display_frame.Maximize(True)
         self.display_frame.resize(wx.DisplaySize())
         self.display_frame.repos(0,0)
@@ -420,11 +672,20 @@ class SettingsFrame(wx.Frame):
         self.display_frame.slicer = self.layers[2]
         self.display_frame.dpi = self.get_dpi()
         self.display_frame.fl_time = self.fl_time
+        self.display_frame.lookahead = self.lookahead
+        self.display_frame.render_workers = self.render_workers
+        self.display_frame.renderer = self.renderer
+        self.display_frame.antialias = self.antialias
+        self.display_frame.lift_sync = self.lift_sync
+        self.display_frame.settle = self.settle
+        self.display_frame.lift_timeout_s = self.lift_timeout
+        self.display_frame.telemetry_dir = self.telemetry_dir
+        self.display_frame.job_name = self.current_filename
         of_x=float(self.X)/2-(float(self.display_frame.part_w)/2)*self.get_dpi()/25.4
         of_y=float(self.Y)/2-(float(self.display_frame.part_h)/2)*self.get_dpi()/25.4
         offset=(of_x,of_y)
 
-        self.display_frame.present(self.layers[0][:],
+        self.display_frame.present(self.layers[0],
             thickness=float(self.thickness),
             interval=float(self.interval),
             overshoot=float(self.overshoot),
@@ -438,7 +699,7 @@ class SettingsFrame(wx.Frame):
     def stop_present2(self):
         self.index=(0)
         self.display_frame.hide_pic()
-        self.display_frame.running = False
+        self.display_frame.stop()
         
 if __name__ == "__main__":
     provider = wx.SimpleHelpProvider()
@@ -140,6 +140,7 @@ class Settings(object):
     def __init__(self):
         self._add(HiddenSetting("port",""))
         self._add(HiddenSetting("baudrate", 115200))
+        self._add(HiddenSetting("rx_buffer", 0))
         self._add(HiddenSetting("project_tiempo_exposicion", 2.0))
         self._add(HiddenSetting("project_pausa", 2.5))
         self._add(HiddenSetting("project_x", 1024))
@@ -148,6 +149,17 @@ class Settings(object):
         self._add(HiddenSetting("project_elevacion", 3.0))
         self._add(HiddenSetting("project_velocidad_z", 200))
         self._add(HiddenSetting("project_primera_capa", 20))
+        self._add(HiddenSetting("project_cache", "~/.printrun/layercache"))
+        self._add(HiddenSetting("project_cache_mb", 256))
+        self._add(HiddenSetting("project_lookahead", 3))
+        self._add(HiddenSetting("project_render_workers", 1))
+        self._add(HiddenSetting("project_renderer", "cairosvg"))
+        self._add(HiddenSetting("project_antialias", 15))
+        self._add(HiddenSetting("project_telemetry", "~/.printrun/telemetry"))
+        self._add(HiddenSetting("project_display", "wx"))
+        self._add(HiddenSetting("project_lift_sync", "ok"))
+        self._add(HiddenSetting("project_settle", 0.5))
+        self._add(HiddenSetting("project_lift_timeout", 30.0))
         self._add(HiddenSetting("pause_between_prints", True))
         self._add(HiddenSetting("default_extrusion", 5.0))
         self._add(HiddenSetting("last_extrusion", 5.0))
@@ -267,6 +279,9 @@ class pronsole(cmd.Cmd):
 
     def online(self):
         self.log("\rPrinter is now online")
+        summary = self.p.connect_summary()
+        if summary:
+            self.log(summary)
         self.write_prompt()
 
     def write_prompt(self):
@@ -424,6 +439,7 @@ class pronsole(cmd.Cmd):
         if baud != self.settings.baudrate:
             self.settings.baudrate = baud
             self.save_in_rc("set baudrate", "set baudrate %d" % baud)
+        self.p.window = self.settings.rx_buffer
         self.p.connect(port, baud)
 
     def complete_connect(self, text, line, begidx, endidx):
@@ -491,6 +507,7 @@ class pronsole(cmd.Cmd):
     def add_cmdline_arguments(self, parser):
         parser.add_argument('-c', '--conf', '--config', help = _("load this file on startup instead of .pronsolerc ; you may chain config files, if so settings auto-save will use the last specified file"), action = "append", default = [])
         parser.add_argument('-e', '--execute', help = _("executes command after configuration/.pronsolerc is loaded ; macros/settings from these commands are not autosaved"), action = "append", default = [])
+        parser.add_argument('--record', metavar = "FILE", help = _("record everything sent to and received from the printer into FILE, to be played back with testtools/replay.py"))
         parser.add_argument('filename', nargs='?', help = _("file to load"))
 
     def process_cmdline_arguments(self, args):
@@ -502,6 +519,8 @@ class pronsole(cmd.Cmd):
         for command in args.execute:
             self.onecmd(command)
         self.processing_args = False
+        if args.record:
+            self.p.start_recording(args.record)
         if args.filename:
             filename = args.filename.decode(locale.getpreferredencoding())
             self.cmdline_filename_callback(filename)
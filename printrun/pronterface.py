@@ -79,6 +79,9 @@ class PronterWindow(MainWindow,pronsole.pronsole):
 
     def online(self):
         print ("Printer is now online.")
+        summary = self.p.connect_summary()
+        if summary:
+            print summary
 
     def project(self, event):
         from printrun import projectlayer
@@ -114,15 +117,12 @@ class PronterWindow(MainWindow,pronsole.pronsole):
         self.connect()
         
     def wait_printer_available(self):
+        # The printer answers once it is done with what it was sent before
         while (True):
-            time.sleep(0.5)
-            self.p.send_now("G0")
-            try:
-                l = self.p._readline()
-                if (l.startswith('ok')):
-                  return
-            except:
-                pass
+            ack = printcore.Ack()
+            self.p.send_now("G0", ack = ack)
+            if ack.wait(5):
+                return
         
     def statuschecker(self):
         while self.statuscheck:
@@ -147,6 +147,7 @@ class PronterWindow(MainWindow,pronsole.pronsole):
             self.p.paused = 0
             self.p.printing = 0
             self.paused = 0
+        self.p.window = self.settings.rx_buffer
         try:
             self.p.connect(port, baud)
         except SerialException as e:
@@ -206,7 +207,10 @@ class PronterApp(wx.App):
         self.mainwindow.load_default_rc()
         self.projector.reload_config()
         # Load part
-        ret=self.projector.load_file_this("/root/part.svg")
+        if os.path.exists("/root/part.zip"):
+            ret=self.projector.load_file_this("/root/part.zip")
+        else:
+            ret=self.projector.load_file_this("/root/part.svg")
         l.put_lines("Imprimiendo...",ret)
         self.projector.display_frame.go_home()
         self.mainwindow.wait_printer_available()
@@ -225,7 +229,8 @@ class PronterApp(wx.App):
         # CUSTOM for arcadeprinter
         self.mainwindow = PronterWindow(self)
         self.projector=self.mainwindow.project_init()
-        self.projector.display_frame.Show()
+        if self.projector.display_frame.backend.gui:
+            self.projector.display_frame.Show()
 
 
 
@@ -0,0 +1,90 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import numpy
+
+class Raster(object):
+    """A rendered layer: 8-bit greyscale, one byte per pixel, row-major"""
+
+    __slots__ = ('width', 'height', 'data')
+
+    def __init__(self, width, height, data):
+        self.width = width
+        self.height = height
+        self.data = data
+
+    def array(self):
+        return numpy.frombuffer(self.data, numpy.uint8).reshape(self.height, self.width)
+
+class FrameBuffer(object):
+    """A full projector frame as packed RGB, the layout wx bitmaps are
+    created from. It is allocated once and layers are composed into it in
+    place."""
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.pixels = numpy.zeros((height, width, 3), numpy.uint8)
+
+    def clear(self):
+        self.pixels.fill(0)
+
+    def blit(self, source, x, y, red=False, scale=1.0):
+        """Copy source, a (h, w) greyscale or (h, w, 3) RGB array, with its
+        top left corner at x, y. scale resamples it nearest-neighbour on the
+        way in; red only lights the red channel, like AdjustChannels(1,0,0)"""
+        h, w = source.shape[:2]
+        if scale != 1.0:
+            rows = (numpy.arange(int(h * scale)) / scale).astype(numpy.intp)
+            cols = (numpy.arange(int(w * scale)) / scale).astype(numpy.intp)
+            h, w = len(rows), len(cols)
+        x, y = int(x), int(y)
+        # Clip against the frame
+        sx, sy = max(0, -x), max(0, -y)
+        dx, dy = max(0, x), max(0, y)
+        cw = min(w - sx, self.width - dx)
+        ch = min(h - sy, self.height - dy)
+        if cw <= 0 or ch <= 0:
+            return
+        if scale != 1.0:
+            source = source[rows[sy:sy + ch, None], cols[None, sx:sx + cw]]
+        else:
+            source = source[sy:sy + ch, sx:sx + cw]
+        target = self.pixels[dy:dy + ch, dx:dx + cw]
+        if red:
+            target[:, :, 0] = source if source.ndim == 2 else source[:, :, 0]
+        elif source.ndim == 2:
+            target[:] = source[:, :, None]
+        else:
+            target[:] = source
+
+def from_rgb(width, height, rgb, alpha=None):
+    """Build a Raster from packed RGB data (and optional alpha plane), as
+    returned by wx.Image.GetData/GetAlphaData, flattened over black"""
+    grey = numpy.frombuffer(rgb, numpy.uint8)[::3]
+    if alpha is not None:
+        grey = (grey.astype(numpy.uint16) * numpy.frombuffer(alpha, numpy.uint8) + 127) // 255
+    return Raster(width, height, grey.astype(numpy.uint8).tostring())
+
+def from_cairo(surface):
+    """Build a Raster from a cairo ARGB32 ImageSurface. Cairo stores alpha
+    premultiplied, so the red channel already is the colour over black"""
+    surface.flush()
+    width, height, stride = surface.get_width(), surface.get_height(), surface.get_stride()
+    pixels = numpy.frombuffer(surface.get_data(), numpy.uint8).reshape(height, stride)
+    # Native endian 32-bit ARGB: BGRA in memory on little endian machines
+    red = 2 if sys.byteorder == "little" else 1
+    return Raster(width, height, pixels[:, red:width * 4:4].tostring())
@@ -0,0 +1,162 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Scanline rasterizer for Slic3r SVG slices. A Slic3r layer is nothing but
+# <polygon points="..."> contours and holes, so instead of handing it to
+# cairosvg the points are parsed straight into NumPy arrays and filled the
+# way cairo fills them: each pixel gets the fraction of it inside the
+# layer, taken on cairo_rows sample rows per pixel and exactly along each
+# row (cairo's own scan converter samples 1/256 of a pixel apart there).
+
+import re
+import numpy
+
+from printrun.raster import Raster
+
+polygon_exp = re.compile(r"<(?:\w+:)?polygon\b([^>]*)>")
+points_exp = re.compile(r"""\bpoints\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+unsupported_exp = re.compile(r"<(?:\w+:)?(?:path|rect|circle|ellipse|polyline|use)\b|\btransform\s*=")
+
+# Sample rows per pixel of cairo's default antialiasing
+cairo_rows = 15
+
+def supported(data):
+    """True if the layer only has polygons, so rasterize matches cairosvg"""
+    return unsupported_exp.search(data) is None
+
+def parse_polygons(data):
+    """Return the polygons of a layer <g> element as (n, 2) float arrays, in
+    user units (mm for Slic3r)"""
+    polygons = []
+    for match in polygon_exp.finditer(data):
+        points = points_exp.search(match.group(1))
+        if points is None:
+            continue
+        text = points.group(1) if points.group(1) is not None else points.group(2)
+        coords = numpy.fromstring(text.replace(",", " "), sep=" ")
+        if len(coords) >= 6:
+            polygons.append(coords[:len(coords) // 2 * 2].reshape(-1, 2))
+    return polygons
+
+def _edges(polygons, k, ky=None):
+    if ky is None:
+        ky = k
+    x0 = numpy.concatenate([p[:, 0] for p in polygons]) * k
+    y0 = numpy.concatenate([p[:, 1] for p in polygons]) * ky
+    # Each polygon closes back onto its first point
+    x1 = numpy.concatenate([numpy.roll(p[:, 0], -1) for p in polygons]) * k
+    y1 = numpy.concatenate([numpy.roll(p[:, 1], -1) for p in polygons]) * ky
+    keep = y0 != y1
+    return x0[keep], y0[keep], x1[keep], y1[keep]
+
+def _crossings(x0, y0, x1, y1, height):
+    """Row, x and index of the edge of every crossing of the edges with
+    the centre lines of rows 0 to height"""
+    # An edge crosses the centre of row r if ymin <= r + 0.5 < ymax
+    lo = numpy.minimum(y0, y1)
+    hi = numpy.maximum(y0, y1)
+    first = numpy.clip(numpy.ceil(lo - 0.5), 0, height).astype(numpy.intp)
+    last = numpy.clip(numpy.ceil(hi - 0.5), 0, height).astype(numpy.intp)
+    counts = last - first
+    total = counts.sum()
+    edge = numpy.repeat(numpy.arange(len(counts)), counts)
+    rows = first[edge] + numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    yc = rows + 0.5
+    xs = x0[edge] + (yc - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+    return rows, xs, edge
+
+def coverage(polygons, width, height, k, fill_rule="evenodd"):
+    """Boolean (height, width) mask of the pixels whose centre is inside the
+    polygons scaled by k pixels per unit"""
+    if not polygons:
+        return numpy.zeros((height, width), bool)
+    x0, y0, x1, y1 = _edges(polygons, k)
+    rows, xs, edge = _crossings(x0, y0, x1, y1, height)
+    if len(rows) == 0:
+        return numpy.zeros((height, width), bool)
+    # First pixel whose centre is at or right of the crossing; crossings
+    # past the right border land in a spare column
+    cols = numpy.clip(numpy.ceil(xs - 0.5), 0, width).astype(numpy.intp)
+    flat = rows * (width + 1) + cols
+    if fill_rule == "nonzero":
+        winding = numpy.where(y1 > y0, 1, -1)[edge]
+        toggles = numpy.bincount(flat, weights=winding, minlength=height * (width + 1))
+        toggles = toggles.astype(numpy.int32).reshape(height, width + 1)
+        return numpy.cumsum(toggles[:, :width], axis=1) != 0
+    elif fill_rule == "evenodd":
+        toggles = numpy.bincount(flat, minlength=height * (width + 1)).astype(numpy.int32)
+        toggles = toggles.reshape(height, width + 1)
+        return (numpy.cumsum(toggles[:, :width], axis=1) & 1).astype(bool)
+    raise ValueError("Unknown fill rule %s" % fill_rule)
+
+def area_coverage(polygons, width, height, k, fill_rule="evenodd", rows=cairo_rows):
+    """(height, width) array of the fraction of each pixel inside the
+    polygons scaled by k pixels per unit, from rows sample rows per pixel"""
+    if fill_rule not in ("evenodd", "nonzero"):
+        raise ValueError("Unknown fill rule %s" % fill_rule)
+    if not polygons:
+        return numpy.zeros((height, width))
+    x0, y0, x1, y1 = _edges(polygons, k, k * rows)
+    sub, xs, edge = _crossings(x0, y0, x1, y1, height * rows)
+    if len(sub) == 0:
+        return numpy.zeros((height, width))
+    # Along a sample row the inside steps up or down at each crossing, in
+    # x order. Every row has all of its crossings, which add up to no
+    # winding, so counting on from the rows before gives the same inside.
+    order = numpy.lexsort((xs, sub))
+    sub = sub[order]
+    xs = numpy.clip(xs[order], 0, width)
+    if fill_rule == "nonzero":
+        winding = numpy.where(y1 > y0, 1, -1)[edge[order]]
+        after = numpy.cumsum(winding)
+        step = (after != 0).astype(numpy.int8) - ((after - winding) != 0)
+    else:
+        step = numpy.where(numpy.arange(len(xs)) & 1, -1, 1)
+    # A step at x covers the rest of its own pixel and all pixels right
+    # of it, up to the next step; crossings past the right border land in
+    # the spare columns
+    cols = numpy.floor(xs).astype(numpy.intp)
+    flat = (sub // rows) * (width + 2) + cols
+    size = height * (width + 2)
+    part = numpy.bincount(flat, weights=step * (cols + 1 - xs), minlength=size)
+    whole = numpy.bincount(flat + 1, weights=step, minlength=size)
+    part = part.reshape(height, width + 2)
+    whole = whole.reshape(height, width + 2)
+    return (numpy.cumsum(whole, axis=1)[:, :width] + part[:, :width]) / rows
+
+def page_size(width_mm, height_mm, dpi, scale=1.0):
+    """Pixel size of the page cairosvg renders for a width x height mm SVG"""
+    k = scale * dpi / 25.4
+    return int(float(width_mm) * k), int(float(height_mm) * k)
+
+def rasterize(data, width_mm, height_mm, dpi, scale=1.0, fill_rule="evenodd", supersample=cairo_rows):
+    """Render a Slic3r layer into an 8-bit Raster the size of the page
+    cairosvg would produce. Edge pixels are antialiased from supersample
+    sample rows per pixel, by default as many as cairo takes; with
+    supersample 1 each pixel is simply on or off by its centre."""
+    width, height = page_size(width_mm, height_mm, dpi, scale)
+    k = scale * dpi / 25.4
+    polygons = parse_polygons(data)
+    if supersample <= 1:
+        mask = coverage(polygons, width, height, k, fill_rule)
+        return Raster(width, height, (mask.view(numpy.uint8) * 255).tostring())
+    area = area_coverage(polygons, width, height, k, fill_rule, supersample)
+    return Raster(width, height, numpy.clip(area * 255 + 0.5, 0, 255).astype(numpy.uint8).tostring())
+
+def rasterize_bits(data, width_mm, height_mm, dpi, scale=1.0, fill_rule="evenodd"):
+    """Like rasterize, as a 1-bit image with rows packed MSB first"""
+    width, height = page_size(width_mm, height_mm, dpi, scale)
+    mask = coverage(parse_polygons(data), width, height, scale * dpi / 25.4, fill_rule)
+    return width, height, numpy.packbits(mask, axis=1).tostring()
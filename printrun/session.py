@@ -0,0 +1,164 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Recordings of what went over the wire between printcore and the printer,
+# to be played back later (see testtools/replay.py). A recording is a magic
+# string followed by one record per write or read:
+#
+#   kind       1 byte, "S" for bytes sent to the printer, "R" for received,
+#              "C" for a connection
+#   time       8 bytes, microseconds since the recording started
+#   length     4 bytes
+#   data       length bytes
+#
+# with the numbers little endian. The data of a connection is how the
+# printer is connected, "serial" or "tcp", followed by " online" when it was
+# online already as the recording started. Recordings made before there
+# were connection records have none.
+
+import struct
+from threading import Lock
+
+from printrun.printrun_utils import install_locale, monotonic
+install_locale('pronterface')
+
+MAGIC = "PRSESS01"
+SENT = "S"
+RECEIVED = "R"
+CONNECTED = "C"
+SERIAL = "serial"
+TCP = "tcp"
+record_header = struct.Struct("<cQI")
+
+class SessionRecorder(object):
+    """Appends what is written to and read from the printer to a
+    recording; sent and received may be called from any thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.started = monotonic()
+        self.lock = Lock()
+
+    def _record(self, kind, data):
+        if not data:
+            return
+        data = str(data)
+        micros = int((monotonic() - self.started) * 1e6)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(record_header.pack(kind, micros, len(data)))
+                self.file.write(data)
+
+    def sent(self, data):
+        self._record(SENT, data)
+
+    def received(self, data):
+        self._record(RECEIVED, data)
+
+    def connected(self, transport, online = False):
+        self._record(CONNECTED, transport + (" online" if online else ""))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def read_session(path):
+    """The records of a recording as (kind, seconds, data)"""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(_("%s is not a session recording") % path)
+        while True:
+            header = f.read(record_header.size)
+            if len(header) < record_header.size:
+                return
+            kind, micros, length = record_header.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield kind, micros / 1e6, data
+
+def session_job(records):
+    """The print job of a recording: the command of every numbered line
+    sent, in line number order, each once however many times it was
+    resent. Numbering starts afresh at each M110, so prints follow each
+    other. Lines are not numbered over TCP, there it is every line sent
+    but M110."""
+    job = []
+    commands = {}
+    unnumbered = []
+    pending = ""
+    for kind, when, data in records:
+        if kind != SENT:
+            continue
+        pending += data
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            if not line.startswith("N"):
+                if line and line != "M110":
+                    unnumbered.append(line)
+                continue
+            if "M110" in line:
+                job.extend(commands[number] for number in sorted(commands))
+                commands = {}
+                continue
+            number, sep, command = line.partition(" ")
+            try:
+                number = int(number[1:])
+            except ValueError:
+                continue
+            commands.setdefault(number, command.rpartition("*")[0] or command)
+    job.extend(commands[number] for number in sorted(commands))
+    return job or unnumbered
+
+def session_transport(records):
+    """SERIAL or TCP, as the recording says, or None if it does not"""
+    for kind, when, data in records:
+        if kind == CONNECTED:
+            return data.split()[0]
+    return None
+
+def session_commands(records):
+    """The commands sent with send_now in a recording over a serial port:
+    every unnumbered line sent but M110 and the probes sent while
+    connecting, those up to the printer's first answer. They come in a
+    list per write, as send_now_many sent them."""
+    writes = []
+    pending = ""
+    probing = False
+    for kind, when, data in records:
+        if kind == CONNECTED:
+            probing = not data.endswith(" online")
+            pending = ""
+            continue
+        if kind == RECEIVED:
+            probing = False
+            continue
+        if kind != SENT:
+            continue
+        pending += data
+        lines = pending.split("\n")
+        pending = lines.pop()
+        if probing:
+            continue
+        commands = [line for line in lines
+                    if line and not line.startswith("N") and line != "M110"]
+        if commands:
+            writes.append(commands)
+    return writes
@@ -0,0 +1,188 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import mmap
+import hashlib
+from array import array
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
+
+SVG_NS = "http://www.w3.org/2000/svg"
+SLIC3R_NS = "http://slic3r.org/namespaces/slic3r"
+
+# expat reports namespaced names as "uri local" with this separator
+SVG_G = SVG_NS + " g"
+SVG_METADATA = SVG_NS + " metadata"
+SLIC3R_Z = SLIC3R_NS + " z"
+
+class SliceLayer(object):
+    """One <g> layer of a sliced SVG, read back from the file on demand"""
+
+    __slots__ = ('source', 'start', 'end', 'z', 'digest')
+
+    def __init__(self, source, start, end, z, digest):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.z = z
+        self.digest = digest
+
+    def data(self):
+        """Raw bytes of the <g> element, exactly as they are in the file"""
+        return self.source.read(self.start, self.end)
+
+    def svg(self, scale=1.0):
+        """Standalone SVG document holding just this layer"""
+        return self.source.wrap(self.data(), scale)
+
+    def identity(self):
+        """Stands in for svg() when keying rendered layers: the same for
+        every layer of the file with identical geometry"""
+        source = self.source
+        return "%s|%s|%s|%s" % (source._header, source.width, source.height, self.digest)
+
+class SliceFile(object):
+    """Index of a Slic3r/Skeinforge SVG slice file.
+
+    The file is parsed once with expat, which only records where each layer
+    starts and ends and its z in flat arrays, so memory barely grows with
+    the layer count. Layer geometry is sliced out of a read-only mmap of the
+    file when a layer is rendered.
+
+    Each layer is also hashed on load, leaving out its id and z, so runs of
+    identical slices (pillars, supports, prismatic sections) can share one
+    rendered raster."""
+
+    def __init__(self, path):
+        self.path = path
+        self.starts = array('L')
+        self.ends = array('L')
+        self.zs = array('d')
+        self.digests = []
+        self.unique = 0
+        self.namespaces = {}
+        self.width = None
+        self.height = None
+        self.slicer = 'Slic3r'
+        self.zdiff = 0
+        self.size = 0
+        self.file = open(path, "rb")
+        self._index()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._hash()
+
+    def _index(self):
+        parser = expat.ParserCreate(namespace_separator=" ")
+        state = {"depth": 0, "z": 0.0, "zlast": 0.0}
+        self._attrs = []
+        namespaces = self.namespaces
+
+        def start_ns(prefix, uri):
+            if state["depth"] == 0:
+                namespaces[prefix] = uri
+
+        def start(name, attrs):
+            depth = state["depth"]
+            if depth == 0:
+                self.height = attrs.get('height', '0').replace('m', '')
+                self.width = attrs.get('width', '0').replace('m', '')
+            elif depth == 1:
+                if name == SVG_G:
+                    self.starts.append(parser.CurrentByteIndex)
+                    state["z"] = float(attrs.get(SLIC3R_Z, 0))
+                    # Attributes that change how the layer renders
+                    self._attrs.append(repr(sorted((k, v) for k, v in attrs.items()
+                                                   if k != 'id' and k != SLIC3R_Z)))
+                elif name == SVG_METADATA:
+                    self.slicer = 'Skeinforge'
+            state["depth"] = depth + 1
+
+        def end(name):
+            state["depth"] -= 1
+            if state["depth"] == 1 and name == SVG_G:
+                # Where the end tag starts; for an empty <g/> expat points
+                # just past it instead, which _hash fixes up
+                self.ends.append(parser.CurrentByteIndex)
+                self.zs.append(state["z"])
+                self.zdiff = state["z"] - state["zlast"]
+                state["zlast"] = state["z"]
+
+        parser.StartNamespaceDeclHandler = start_ns
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.ParseFile(self.file)
+        self.file.seek(0, 2)
+        self.size = self.file.tell()
+        self._header = self._make_header()
+
+    def _hash(self):
+        seen = set()
+        for i, (start, end, attrs) in enumerate(zip(self.starts, self.ends, self._attrs)):
+            close = self.map.find(">", start)
+            if self.map[close - 1] == "/":
+                # Empty element, make end point at its closing '>'
+                end = self.ends[i] = close
+            h = hashlib.sha1(attrs)
+            # Contents between the start and end tags; empty for <g/>
+            h.update(self.map[close + 1:end])
+            digest = h.hexdigest()
+            self.digests.append(digest)
+            seen.add(digest)
+        self.unique = len(seen)
+        del self._attrs
+
+    def dedup_ratio(self):
+        """Fraction of the layers that repeat an earlier one"""
+        if not self.digests:
+            return 0.0
+        return 1.0 - float(self.unique) / len(self.digests)
+
+    def _make_header(self):
+        decls = []
+        for prefix, uri in sorted(self.namespaces.items()):
+            name = "xmlns:" + prefix if prefix else "xmlns"
+            decls.append("%s=%s" % (name, quoteattr(uri)))
+        if None not in self.namespaces and "" not in self.namespaces:
+            decls.append("xmlns=%s" % quoteattr(SVG_NS))
+        return " ".join(decls)
+
+    def read(self, start, end):
+        # end is the position of the closing tag, include it
+        return self.map[start:self.map.find(">", end) + 1]
+
+    def wrap(self, data, scale=1.0):
+        width, height = self.width, self.height
+        if scale != 1.0:
+            width = str(float(width) * scale)
+            height = str(float(height) * scale)
+            data = '<g transform="scale(%s)">%s</g>' % (scale, data)
+        return ('<svg %s height="%smm" width="%smm" viewBox="0 0 %s %s" '
+                'style="background-color:black;fill:white;">%s</svg>'
+                % (self._header, height, width, width, height, data))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        return SliceLayer(self, self.starts[index], self.ends[index], self.zs[index],
+                          self.digests[index])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
@@ -0,0 +1,94 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import csv
+import time
+import logging
+from threading import Lock
+
+try: import simplejson as json
+except ImportError: import json
+
+from printrun.exposure import percentile
+
+class JobTelemetry(object):
+    """Per-layer phase durations of a resin job, in seconds.
+
+    render    rasterizing (or fetching from cache) the layer
+    show      drawing the layer on the display
+    exposure  measured time the layer was lit
+    lift_ack  from writing the G2 lift to the printer's ok
+    idle      dark time between a layer going off and the next going on"""
+
+    phases = ("render", "show", "exposure", "lift_ack", "idle")
+
+    def __init__(self, name="job"):
+        self.name = name
+        self.started = time.time()
+        self.layers = {}
+        self.lock = Lock()
+
+    def record(self, index, phase, seconds):
+        with self.lock:
+            self.layers.setdefault(index, {})[phase] = seconds
+
+    def summary(self):
+        summary = {}
+        with self.lock:
+            for phase in self.phases:
+                values = [layer[phase] for layer in self.layers.values() if phase in layer]
+                summary[phase] = {"count": len(values),
+                                  "p50": percentile(values, 0.5),
+                                  "p95": percentile(values, 0.95),
+                                  "max": max(values) if values else 0.0}
+        return summary
+
+    def format_summary(self):
+        lines = ["%-9s %6s %9s %9s %9s" % ("phase", "layers", "p50 ms", "p95 ms", "max ms")]
+        summary = self.summary()
+        for phase in self.phases:
+            s = summary[phase]
+            lines.append("%-9s %6d %9.1f %9.1f %9.1f" % (phase, s["count"], 1000 * s["p50"],
+                                                        1000 * s["p95"], 1000 * s["max"]))
+        return "\n".join(lines)
+
+    def write(self, directory):
+        """Write <name>-<date>.csv with one row per layer and a .json with
+        the same rows plus the summary. Returns the path prefix used."""
+        directory = os.path.expanduser(directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        prefix = os.path.join(directory, "%s-%s" % (os.path.splitext(self.name)[0], stamp))
+        with self.lock:
+            rows = [dict(self.layers[index], layer=index) for index in sorted(self.layers)]
+        with open(prefix + ".csv", "wb") as f:
+            writer = csv.DictWriter(f, ("layer",) + self.phases)
+            writer.writeheader()
+            writer.writerows(rows)
+        with open(prefix + ".json", "w") as f:
+            json.dump({"job": self.name,
+                       "started": self.started,
+                       "summary": self.summary(),
+                       "layers": rows}, f, indent=1)
+        return prefix
+
+    def save(self, directory):
+        try:
+            return self.write(directory)
+        except (IOError, OSError) as e:
+            logging.warning("Could not write job telemetry to %s: %s" % (directory, e))
+            return None
@@ -0,0 +1,88 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import unittest
+
+from printrun.exposure import ExposureScheduler
+from printrun.printrun_utils import monotonic
+
+class SlowDisplayJob(object):
+    """A job whose progress takes as long as the LCD does"""
+
+    exposure = 0.1
+    progress_delay = 1.0
+
+    def __init__(self):
+        self.shown = {}
+        self.hidden = {}
+        self.reported = []
+        self.completed = None
+
+    def prepare(self, i):
+        return i
+
+    def expose(self, i, layer):
+        self.shown[i] = monotonic()
+
+    def shutter_delay(self, i):
+        return 0
+
+    def open_shutter(self, i):
+        pass
+
+    def exposure_time(self, i):
+        return self.exposure
+
+    def hide(self, i):
+        self.hidden[i] = monotonic()
+
+    def lift_delay(self, i):
+        return 0.0
+
+    def lift(self, i):
+        return None
+
+    def lift_timeout(self, i):
+        return 1.0
+
+    def settle_time(self, i):
+        return 0.0
+
+    def progress(self, i):
+        time.sleep(self.progress_delay)
+        self.reported.append(i)
+
+    def finish(self, completed):
+        self.completed = completed
+
+class ExposureSchedulerTest(unittest.TestCase):
+
+    def test_slow_progress_does_not_delay_hide(self):
+        job = SlowDisplayJob()
+        scheduler = ExposureScheduler(job, 3)
+        started = monotonic()
+        scheduler.start()
+        scheduler.join(10)
+        self.assertTrue(job.completed)
+        for i in range(3):
+            self.assertLess(job.hidden[i] - job.shown[i], job.exposure + 0.05)
+        # The whole cycle did not wait for the display either
+        self.assertLess(job.hidden[2] - started, 3 * job.exposure + 0.2)
+        # The last layer is reported before the job finishes
+        self.assertEqual(job.reported[-1], 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "testtools"))
+from fakefirmware import FakeFirmware
+
+from printrun import gcoder
+from printrun.loopcore import loopcore
+
+def wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+class LoopcoreTest(unittest.TestCase):
+
+    def connect(self, firmware, window = 0):
+        core = loopcore()
+        core.errorcb = lambda error: None
+        core.window = window
+        core.connect(firmware.spawn(), 115200)
+        self.addCleanup(self.stop, firmware)
+        self.addCleanup(core.disconnect)
+        self.assertTrue(wait_for(lambda: core.online, 10))
+        return core
+
+    def stop(self, firmware):
+        """Kill the firmware unless that was done already, return its stats"""
+        if firmware.pid is None:
+            return None
+        stats = firmware.kill()
+        firmware.pid = None
+        return stats
+
+    def test_reports_where_connect_time_went(self):
+        core = self.connect(FakeFirmware())
+        stats = core.connect_stats
+        for key in ("open", "hup", "first_reply", "online"):
+            self.assertIsNotNone(stats[key], key)
+        self.assertLessEqual(stats["open"], stats["first_reply"])
+        self.assertLessEqual(stats["first_reply"], stats["online"])
+        self.assertTrue(core.connect_summary().startswith("Online after"))
+
+    def test_streams_through_a_firmware_that_drops_lines_on_error(self):
+        firmware = FakeFirmware(delay = 0.0002, error_rate = 0.01, seed = 1, flush_on_error = True)
+        core = self.connect(firmware, window = 127)
+        core.drain_timeout = 0.2
+        lines = ["G1 X%d Y%d" % (i, 3 * i) for i in range(3000)]
+        core.startprint(gcoder.GCode(lines))
+        self.assertTrue(wait_for(lambda: not core.printing, 30))
+        self.assertTrue(core.completed)
+        core.disconnect()
+        stats = self.stop(firmware)
+        self.assertEqual(stats["accepted"], len(lines))
+        self.assertGreater(stats["dropped"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Streams a print through printcore to the fake firmware and reports lines
+# per second and the CPU time printcore's process used doing it.
+#
+#   python testtools/bench_printcore.py [-n LINES] [--delay SECONDS]
+#                                       [--latency SECONDS] [--window BYTES]
+#                                       [--no-analyze] [--idle SECONDS]
+#
+# --window streams against a receive buffer of that many bytes instead of
+# waiting for every ok.
+# --idle also measures CPU use while connected and not printing.
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.printcore import printcore
+from fakefirmware import FakeFirmware
+
+def cpu():
+    t = os.times()
+    return t[0] + t[1]
+
+def wait_for(condition, timeout):
+    start = time.time()
+    while not condition():
+        if time.time() - start > timeout:
+            return False
+        time.sleep(0.01)
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description = "printcore streaming benchmark")
+    parser.add_argument("-n", "--lines", type = int, default = 20000)
+    parser.add_argument("--delay", type = float, default = 0.0,
+                        help = "seconds the firmware takes per line")
+    parser.add_argument("--latency", type = float, default = 0.0,
+                        help = "seconds before each answer reaches the host")
+    parser.add_argument("--window", type = int, default = 0,
+                        help = "firmware receive buffer to stream against, in bytes")
+    parser.add_argument("--no-analyze", action = "store_true",
+                        help = "do not run sent commands through the analyzer")
+    parser.add_argument("--idle", type = float, default = 0.0,
+                        help = "also measure CPU use idling for this long")
+    args = parser.parse_args()
+    firmware = FakeFirmware(args.delay, args.latency)
+    port = firmware.spawn()
+    p = printcore()
+    p.window = args.window
+    p.analyze = not args.no_analyze
+    try:
+        p.connect(port, 115200)
+        if not wait_for(lambda: p.online, 10):
+            print "Fake firmware never came online"
+            return
+        if args.idle:
+            start, used = time.time(), cpu()
+            time.sleep(args.idle)
+            print "idle:     %5.1f%% CPU" % (100 * (cpu() - used) / (time.time() - start))
+        lines = ["G1 X%d.%d Y%d.%d E%d.%d" % (i % 200, i % 10, (i * 7) % 200, i % 3, i, i % 5)
+                 for i in xrange(args.lines)]
+        gcode = gcoder.GCode(lines)
+        start, used = time.time(), cpu()
+        p.startprint(gcode)
+        wait_for(lambda: not p.printing, 3600)
+        elapsed = time.time() - start
+        used = cpu() - used
+        print "printing: %8.0f lines/s, %.2fs CPU for %d lines (%5.1f%% CPU, %.1f us CPU/line)" % (
+            args.lines / elapsed, used, args.lines, 100 * used / elapsed, 1e6 * used / args.lines)
+    finally:
+        p.disconnect()
+        firmware.kill()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Per-layer render time of the NumPy rasterizer against cairosvg, and how
+# many pixels differ between the two.
+#
+#   python testtools/bench_rasterizer.py [--dpi DPI] [-n LAYERS] [file.svg]
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+import cStringIO
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import raster, rasterizer
+from printrun.svgslices import SliceFile
+import bench_svgload
+
+try:
+    import cairo
+    from cairosvg.surface import PNGSurface
+except ImportError:
+    cairo = None
+
+def render_cairosvg(layer, dpi):
+    stream = cStringIO.StringIO(PNGSurface.convert(dpi = dpi, bytestring = layer.svg()))
+    return raster.from_cairo(cairo.ImageSurface.create_from_png(stream))
+
+def main():
+    parser = argparse.ArgumentParser(description = "Layer rasterizer benchmark")
+    parser.add_argument("-n", "--layers", type = int, default = 50)
+    parser.add_argument("--dpi", type = float, default = 1024 / (181.0 / 25.4))
+    parser.add_argument("--antialias", type = int, default = rasterizer.cairo_rows)
+    parser.add_argument("filename", nargs = "?")
+    args = parser.parse_args()
+    path = args.filename
+    tmp = None
+    if path is None:
+        fd, tmp = tempfile.mkstemp(suffix = ".svg")
+        os.close(fd)
+        bench_svgload.generate(tmp, args.layers, 8, 400)
+        path = tmp
+    try:
+        slices = SliceFile(path)
+        count = min(args.layers, len(slices))
+        start = time.time()
+        ours = [rasterizer.rasterize(slices[i].data(), slices.width, slices.height, args.dpi,
+                                     supersample = args.antialias)
+                for i in xrange(count)]
+        numpy_time = (time.time() - start) / count
+        print "numpy:    %8.2f ms/layer (%dx%d)" % (numpy_time * 1000, ours[0].width, ours[0].height)
+        if cairo is None:
+            print "cairosvg not installed, skipping comparison"
+            return
+        start = time.time()
+        theirs = [render_cairosvg(slices[i], args.dpi) for i in xrange(count)]
+        cairo_time = (time.time() - start) / count
+        print "cairosvg: %8.2f ms/layer (%dx%d)" % (cairo_time * 1000, theirs[0].width, theirs[0].height)
+        print "speedup:  %8.1fx" % (cairo_time / numpy_time)
+        differ = edge = total = 0
+        for a, b in zip(ours, theirs):
+            if (a.width, a.height) != (b.width, b.height):
+                print "size mismatch", (a.width, a.height), (b.width, b.height)
+                continue
+            diff = numpy.abs(a.array().astype(int) - b.array().astype(int))
+            differ += (diff > 0).sum()
+            # Antialiased edge pixels of cairo are neither black nor white
+            edge += ((b.array() > 0) & (b.array() < 255)).sum()
+            total += diff.size
+        print "differing pixels: %d of %d (%d antialiased edge pixels in cairosvg output)" % (differ, total, edge)
+    finally:
+        if tmp is not None:
+            os.remove(tmp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares load time and peak memory of the streaming SliceFile loader
+# against the ElementTree based loader projectlayer used before it.
+#
+#   python testtools/bench_svgload.py [-n LAYERS] [-p POLYGONS] [file.svg]
+#
+# Without a file a synthetic Slic3r-like SVG is generated. Each loader runs
+# in a forked child so peak RSS is measured independently. SliceFile's peak
+# after reading every layer includes the page cache of the mmapped file,
+# which the kernel can drop at any time.
+
+import os
+import sys
+import math
+import time
+import resource
+import tempfile
+import argparse
+import cPickle
+import xml.etree.ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun.svgslices import SliceFile
+
+def legacy_parse_svg(name):
+    """The pre-SliceFile SettingsFrame.parse_svg, minus wx"""
+    et = xml.etree.ElementTree.ElementTree(file=name)
+    slicer = 'Slic3r' if et.getroot().find('{http://www.w3.org/2000/svg}metadata') == None else 'Skeinforge'
+    zlast = 0
+    zdiff = 0
+    ol = []
+    height = et.getroot().get('height').replace('m','')
+    width = et.getroot().get('width').replace('m','')
+    for i in et.findall("{http://www.w3.org/2000/svg}g"):
+        z = float(i.get('{http://slic3r.org/namespaces/slic3r}z'))
+        zdiff = z - zlast
+        zlast = z
+        svgSnippet = xml.etree.ElementTree.Element('{http://www.w3.org/2000/svg}svg')
+        svgSnippet.set('height', height + 'mm')
+        svgSnippet.set('width', width + 'mm')
+        svgSnippet.set('viewBox', '0 0 ' + width + ' ' + height)
+        svgSnippet.set('style','background-color:black;fill:white;')
+        svgSnippet.append(i)
+        ol += [svgSnippet]
+    # start_present2 used to copy the list once more
+    return ol[:], zdiff, slicer
+
+def legacy_layer(layers, i):
+    return xml.etree.ElementTree.tostring(layers[0][i])
+
+def slicefile_parse_svg(name):
+    slices = SliceFile(name)
+    return slices, slices.zdiff, slices.slicer
+
+def slicefile_layer(layers, i):
+    return layers[0][i].svg()
+
+def generate(path, layers, polygons, points):
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n')
+        f.write('<svg width="60" height="40" xmlns="http://www.w3.org/2000/svg" '
+                'xmlns:svg="http://www.w3.org/2000/svg" '
+                'xmlns:slic3r="http://slic3r.org/namespaces/slic3r">\n')
+        for i in xrange(layers):
+            f.write('  <g id="layer%d" slic3r:z="%f">\n' % (i, 0.05 * (i + 1)))
+            for p in xrange(polygons):
+                r = 2 + 15.0 * (p + 1) / polygons + math.sin(i * 0.01)
+                pts = " ".join("%f,%f" % (30 + r * math.cos(2 * math.pi * k / points),
+                                          20 + r * math.sin(2 * math.pi * k / points))
+                               for k in xrange(points))
+                kind, fill = ("contour", "white") if p % 2 == 0 else ("hole", "black")
+                f.write('    <polygon slic3r:type="%s" points="%s" style="fill: %s" />\n' % (kind, pts, fill))
+            f.write('  </g>\n')
+        f.write('</svg>\n')
+
+def measure(load, layer, path):
+    """Run in a child process: load, then touch every layer"""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        layers = load(path)
+        loaded = time.time()
+        peak_load = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        first = layer(layers, 0)
+        first_layer = time.time()
+        for i in xrange(len(layers[0])):
+            layer(layers, i)
+        done = time.time()
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(w, cPickle.dumps({"layers": len(layers[0]),
+                                   "load": loaded - start,
+                                   "first": first_layer - start,
+                                   "all": done - loaded,
+                                   "load_kb": peak_load - base,
+                                   "peak_kb": peak - base}))
+        os._exit(0)
+    os.close(w)
+    data = ""
+    while True:
+        chunk = os.read(r, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(r)
+    os.waitpid(pid, 0)
+    return cPickle.loads(data)
+
+def main():
+    parser = argparse.ArgumentParser(description = "SVG slice loader benchmark")
+    parser.add_argument("-n", "--layers", type = int, default = 2000)
+    parser.add_argument("-p", "--polygons", type = int, default = 6)
+    parser.add_argument("--points", type = int, default = 120)
+    parser.add_argument("filename", nargs = "?")
+    args = parser.parse_args()
+    path = args.filename
+    tmp = None
+    if path is None:
+        fd, tmp = tempfile.mkstemp(suffix = ".svg")
+        os.close(fd)
+        generate(tmp, args.layers, args.polygons, args.points)
+        path = tmp
+    try:
+        print "%s: %.1f MB" % (path, os.path.getsize(path) / 1048576.0)
+        print "%-12s %7s %9s %11s %12s %12s %12s" % ("loader", "layers", "load s",
+                                                     "1st layer s", "all layers s",
+                                                     "load RSS MB", "peak RSS MB")
+        for name, load, layer in (("ElementTree", legacy_parse_svg, legacy_layer),
+                                  ("SliceFile", slicefile_parse_svg, slicefile_layer)):
+            res = measure(load, layer, path)
+            print "%-12s %7d %9.3f %11.3f %12.3f %12.1f %12.1f" % (name, res["layers"],
+                                                                 res["load"], res["first"], res["all"],
+                                                                 res["load_kb"] / 1024.0, res["peak_kb"] / 1024.0)
+    finally:
+        if tmp is not None:
+            os.remove(tmp)
+
+if __name__ == "__main__":
+    main()
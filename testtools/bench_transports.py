@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Runs printcore against the fake firmware over every transport, a pty
+# and TCP, each waiting for every ok and streaming against a receive
+# buffer, and reports for each:
+#
+#   lines/s    a clean print
+#   CPU        CPU time used per line during that print
+#   ack        round trip of a command sent while idle, median and worst
+#   resend     lines/s of a print with injected checksum errors, and how
+#              long the firmware waited for each line it asked again for
+#
+#   python testtools/bench_transports.py [-n LINES] [--pings N]
+#                                        [--delay SECONDS] [--latency SECONDS]
+#                                        [--window BYTES] [--error-rate RATE]
+#                                        [--transport pty|tcp]
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.printcore import printcore, Ack
+from fakefirmware import FakeFirmware
+from bench_printcore import cpu, wait_for
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def ms(seconds):
+    return "-" if seconds is None else "%.2f" % (1000 * seconds)
+
+class Run(object):
+    """printcore on one transport against a firmware of its own"""
+
+    def __init__(self, args, transport, window, error_rate = 0.0):
+        self.firmware = FakeFirmware(args.delay, args.latency, error_rate, seed = 1)
+        # Forked before printcore starts its threads
+        self.port = self.firmware.spawn(tcp = transport == "tcp")
+        self.p = printcore()
+        self.p.window = window
+        self.p.analyze = False
+        # The injected errors are expected, keep them off the report
+        self.errors = []
+        self.p.errorcb = self.errors.append
+        self.stats = None
+
+    def __enter__(self):
+        self.p.connect(self.port, 115200)
+        if not wait_for(lambda: self.p.online, 10):
+            self.__exit__()
+            raise RuntimeError("Fake firmware never came online")
+        return self
+
+    def __exit__(self, *exc):
+        self.p.disconnect()
+        self.stats = self.firmware.kill()
+
+    def print_lines(self, lines):
+        """Print lines, returns the seconds and CPU seconds it took"""
+        gcode = gcoder.GCode(lines)
+        start, used = time.time(), cpu()
+        self.p.startprint(gcode)
+        wait_for(lambda: not self.p.printing, 3600)
+        return time.time() - start, cpu() - used
+
+    def ping(self, count):
+        """Round trips of M105 sent while not printing"""
+        latencies = []
+        for i in xrange(count):
+            ack = Ack()
+            self.p.send_now("M105", ack = ack)
+            if not ack.wait(5):
+                break
+            latencies.append(ack.latency())
+        return latencies
+
+def bench(args, transport, window, lines):
+    with Run(args, transport, window) as run:
+        elapsed, used = run.print_lines(lines)
+        latencies = run.ping(args.pings)
+    result = {"rate": len(lines) / elapsed,
+              "cpu": used / len(lines),
+              "ack": percentile(latencies, 0.5),
+              "ack_worst": max(latencies) if latencies else None,
+              "resend_rate": None,
+              "recovery": None,
+              "recovery_worst": None,
+              "resends": 0,
+              "intact": None}
+    if transport == "tcp" or not args.error_rate:
+        # No line numbers over TCP, so nothing to resend
+        return result
+    with Run(args, transport, window, args.error_rate) as run:
+        elapsed, used = run.print_lines(lines)
+    recoveries = run.stats["recoveries"]
+    result.update({"resend_rate": len(lines) / elapsed,
+                   "recovery": percentile(recoveries, 0.5),
+                   "recovery_worst": max(recoveries) if recoveries else None,
+                   "resends": run.stats["resends"],
+                   "intact": run.stats["accepted"] == len(lines)})
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description = "printcore benchmarks over each transport")
+    parser.add_argument("-n", "--lines", type = int, default = 10000)
+    parser.add_argument("--pings", type = int, default = 200,
+                        help = "round trips to time while idle")
+    parser.add_argument("--delay", type = float, default = 0.0,
+                        help = "seconds the firmware takes per line")
+    parser.add_argument("--latency", type = float, default = 0.0,
+                        help = "seconds before each answer reaches the host")
+    parser.add_argument("--window", type = int, default = 127,
+                        help = "firmware receive buffer for the streaming runs, in bytes")
+    parser.add_argument("--error-rate", type = float, default = 0.01,
+                        help = "share of lines the firmware asks a resend for")
+    parser.add_argument("--transport", choices = ["pty", "tcp"], action = "append",
+                        help = "only benchmark this transport; repeat for more")
+    args = parser.parse_args()
+    lines = ["G1 X%d.%d Y%d.%d E%d.%d" % (i % 200, i % 10, (i * 7) % 200, i % 3, i, i % 5)
+             for i in xrange(args.lines)]
+    print "%-4s %6s %9s %8s %17s %9s %8s %17s" % (
+        "via", "window", "lines/s", "us CPU", "ack ms (worst)",
+        "resend/s", "resends", "recovery ms (worst)")
+    for transport in args.transport or ["pty", "tcp"]:
+        for window in (0, args.window):
+            r = bench(args, transport, window, lines)
+            resend = "-" if r["resend_rate"] is None else "%.0f" % r["resend_rate"]
+            if r["intact"] is False:
+                resend += "!"
+            print "%-4s %6d %9.0f %8.1f %17s %9s %8d %17s" % (
+                transport, window, r["rate"], 1e6 * r["cpu"],
+                "%s (%s)" % (ms(r["ack"]), ms(r["ack_worst"])),
+                resend, r["resends"],
+                "%s (%s)" % (ms(r["recovery"]), ms(r["recovery_worst"])))
+            sys.stdout.flush()
+    print "! marks a print the firmware did not get every line of, in order"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# A stand-in for printer firmware on a pseudo terminal, so printcore can be
+# exercised without hardware. It speaks the Marlin protocol as printcore
+# expects it: greets with "start", answers every line with "ok", M105 with
+# a temperature report, and checks line numbers and checksums, asking for a
+# "Resend: N" when they are wrong. error_rate makes it reject that share of
+# numbered lines as if they had been garbled on the way. With
+# flush_on_error it also throws away whatever else it has received and not
+# processed yet when it asks for a resend, without answering it, as
+# Marlin's FlushSerialRequestResend does.
+#
+# It also knows this machine's own commands: G2 O<overshoot> L<layer> lifts
+# the build plate by one layer, G93 and G94 open and close the servo and
+# M210 sets the homing feedrate.
+#
+# Lines are processed one after the other, delay seconds each plus whatever
+# --command-delay gives their command, and every answer goes out latency
+# seconds after the line was processed, like over a slow link.
+#
+#   python testtools/fakefirmware.py [--delay SECONDS] [--latency SECONDS]
+#                                    [--command-delay CODE=SECONDS ...]
+#                                    [--error-rate RATE] [--flush-on-error]
+#                                    [--report SECONDS] [--tcp PORT]
+#
+# prints the pty (or with --tcp, the host:port) to connect to and serves
+# until killed. Over TCP it takes one connection at a time and greets each
+# with "start"; printcore sends no line numbers over TCP, so no errors are
+# injected there.
+
+import os
+import re
+import pty
+import tty
+import sys
+import json
+import time
+import random
+import select
+import signal
+import socket
+import argparse
+from collections import deque
+
+gcode_word = re.compile(r"([A-Z])\s*([-+]?[0-9]*\.?[0-9]*)")
+
+def checksum(prefix):
+    return reduce(lambda x, y: x ^ y, bytearray(prefix), 0)
+
+class FakeFirmware(object):
+
+    def __init__(self, delay = 0.0, latency = 0.0, error_rate = 0.0,
+                 delays = None, report = 0.0, seed = None, flush_on_error = False):
+        # Time the firmware takes to process each line before its ok
+        self.delay = delay
+        self.latency = latency
+        # Extra time taken by particular commands, by code ("G28", "G2"...)
+        self.delays = dict(delays or {})
+        # Share of numbered lines rejected with a checksum error
+        self.error_rate = error_rate
+        # Drop the rest of the receive buffer on an error
+        self.flush_on_error = flush_on_error
+        self.flushing = False
+        # Seconds between unsolicited temperature reports, 0 for none
+        self.report = report
+        self.random = random.Random(seed)
+        self.master = None
+        self.port = None
+        self.listener = None
+        self.pid = None
+        self.stats_fd = None
+        self.lines = 0
+        # Numbered lines accepted, resends asked for, and how long each
+        # resend took from asking to getting the line right
+        self.accepted = 0
+        self.resends = 0
+        self.recoveries = []
+        # Lines thrown away unanswered by flush_on_error
+        self.dropped = 0
+        self.reset()
+
+    def reset(self):
+        """Power on state"""
+        self.last_line = 0
+        self.resend_at = None
+        self.relative = False
+        self.z = 0.0
+        self.servo_open = False
+        self.homing_feedrate = None
+        self.extruder = (20.0, 0.0)
+        self.bed = (20.0, 0.0)
+        self.now = time.time()
+
+    def open(self):
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        # Keep the slave open so the pty survives printcore reconnecting
+        self.slave = slave
+        return self.port
+
+    def open_tcp(self, port = 0):
+        """Listen on localhost, on a free port unless one is given"""
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", port))
+        self.listener.listen(1)
+        self.port = "127.0.0.1:%d" % self.listener.getsockname()[1]
+        return self.port
+
+    def temperature(self):
+        return "T:%.1f /%.1f B:%.1f /%.1f" % (self.extruder + self.bed)
+
+    def cost(self, line):
+        """Seconds it takes to process line"""
+        words = line.split()
+        if words and words[0].startswith("N"):
+            words = words[1:]
+        if not words:
+            return self.delay
+        return self.delay + self.delays.get(words[0].split("*")[0].upper(), 0.0)
+
+    def resend(self, error):
+        self.resends += 1
+        if self.resend_at is None:
+            self.resend_at = self.now
+        self.flushing = self.flush_on_error
+        return "Error:%s, Last Line: %d\nResend: %d\nok\n" % (error, self.last_line, self.last_line + 1)
+
+    def reply(self, line):
+        """The answer to line, as sent back to the host"""
+        self.lines += 1
+        line = line.strip()
+        if line.startswith("N"):
+            command, star, check = line.partition("*")
+            if not star:
+                return self.resend("No Checksum with line number")
+            try:
+                number = int(command.split()[0][1:])
+                valid = int(check) == checksum(command)
+            except ValueError:
+                valid = False
+            if not valid:
+                return self.resend("checksum mismatch")
+            command = command.split(None, 1)[1] if " " in command else ""
+            if "M110" not in command:
+                if number != self.last_line + 1:
+                    return self.resend("Line Number is not Last Line Number+1")
+                if self.error_rate and self.random.random() < self.error_rate:
+                    return self.resend("checksum mismatch")
+                self.accepted += 1
+                if self.resend_at is not None:
+                    self.recoveries.append(self.now - self.resend_at)
+                    self.resend_at = None
+            self.last_line = number
+            line = command
+        return self.execute(line)
+
+    def execute(self, command):
+        words = gcode_word.findall(command.upper())
+        if not words:
+            return "ok\n"
+        try:
+            code = "%s%d" % (words[0][0], int(float(words[0][1])))
+        except ValueError:
+            return "ok\n"
+        args = dict(words[1:])
+
+        def arg(letter, default = None):
+            try:
+                return float(args[letter])
+            except (KeyError, ValueError):
+                return default
+        if code == "M105":
+            return "ok %s\n" % self.temperature()
+        elif code in ("M104", "M109"):
+            # Heaters get there at once
+            target = arg("S", 0.0)
+            self.extruder = (target or 20.0, target)
+        elif code in ("M140", "M190"):
+            target = arg("S", 0.0)
+            self.bed = (target or 20.0, target)
+        elif code == "M114":
+            return "X:0.00 Y:0.00 Z:%.2f E:0.00\nok\n" % self.z
+        elif code == "M110":
+            self.last_line = int(arg("N", self.last_line))
+        elif code == "G90":
+            self.relative = False
+        elif code == "G91":
+            self.relative = True
+        elif code == "G28":
+            self.z = 0.0
+        elif code in ("G0", "G1"):
+            z = arg("Z")
+            if z is not None:
+                self.z = self.z + z if self.relative else z
+        elif code == "G2":
+            # The overshoot goes up and comes back down, only the layer stays
+            overshoot, layer = arg("O"), arg("L")
+            if overshoot is None or layer is None:
+                return "Error:G2 needs O and L\nok\n"
+            self.z = self.z + layer if self.relative else layer
+        elif code == "G93":
+            self.servo_open = True
+        elif code == "G94":
+            self.servo_open = False
+        elif code == "M210":
+            self.homing_feedrate = arg("Z", self.homing_feedrate)
+        return "ok\n"
+
+    def write(self, data):
+        # A full pty takes only part of a write
+        while data:
+            data = data[os.write(self.master, data):]
+
+    def serve(self):
+        if self.listener is None:
+            return self.serve_stream()
+        while True:
+            connection = self.listener.accept()[0]
+            # Answers go out as they are written, as from a serial bridge
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.master = connection.fileno()
+            self.reset()
+            try:
+                self.serve_stream()
+            except OSError:
+                # The host went away in the middle of a write
+                pass
+            finally:
+                connection.close()
+
+    def serve_stream(self):
+        self.write("start\n")
+        buf = ""
+        # (when, answer) not sent yet
+        pending = deque()
+        busy_until = 0.0
+        next_report = time.time() + self.report if self.report else None
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0.0, pending[0][0] - time.time())
+            if next_report is not None:
+                timeout = max(0.0, min(timeout if timeout is not None else self.report,
+                                       next_report - time.time()))
+            if select.select([self.master], [], [], timeout)[0]:
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:
+                    return
+                if not data:
+                    return
+                buf += data
+                while "\n" in buf:
+                    line, buf = buf.split("\n", 1)
+                    busy_until = max(busy_until, time.time()) + self.cost(line)
+                    self.now = busy_until
+                    pending.append((busy_until + self.latency, self.reply(line)))
+                    if self.flushing:
+                        self.flushing = False
+                        self.dropped += buf.count("\n")
+                        buf = ""
+            now = time.time()
+            out = []
+            while pending and pending[0][0] <= now:
+                out.append(pending.popleft()[1])
+            if next_report is not None and next_report <= now:
+                out.append(self.temperature() + "\n")
+                next_report = now + self.report
+            if out:
+                self.write("".join(out))
+
+    def stats(self):
+        return {"lines": self.lines,
+                "accepted": self.accepted,
+                "resends": self.resends,
+                "dropped": self.dropped,
+                "recoveries": self.recoveries}
+
+    def spawn(self, tcp = False):
+        """Serve from a child process, so its CPU time is not counted
+        against the host under test. Returns the port."""
+        port = self.open_tcp() if tcp else self.open()
+        stats_fd, stats_out = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(stats_fd)
+
+            def terminate(signum, frame):
+                os.write(stats_out, json.dumps(self.stats()))
+                os._exit(0)
+            signal.signal(signal.SIGTERM, terminate)
+            try:
+                self.serve()
+            finally:
+                os._exit(0)
+        os.close(stats_out)
+        self.stats_fd = stats_fd
+        return port
+
+    def kill(self):
+        """Stop the spawned firmware. Returns its stats()."""
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        data = ""
+        while True:
+            chunk = os.read(self.stats_fd, 65536)
+            if not chunk:
+                break
+            data += chunk
+        os.close(self.stats_fd)
+        return json.loads(data) if data else None
+
+def command_delay(spec):
+    code, sep, seconds = spec.partition("=")
+    try:
+        return code.upper(), float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected CODE=SECONDS, got %s" % spec)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Fake printer firmware on a pty")
+    parser.add_argument("--delay", type = float, default = 0.0,
+                        help = "seconds to process each line")
+    parser.add_argument("--latency", type = float, default = 0.0,
+                        help = "seconds before each answer arrives")
+    parser.add_argument("--command-delay", type = command_delay, action = "append", default = [],
+                        metavar = "CODE=SECONDS",
+                        help = "extra seconds to process a command, as G28=2; repeat for each")
+    parser.add_argument("--error-rate", type = float, default = 0.0,
+                        help = "share of numbered lines to ask a resend for")
+    parser.add_argument("--flush-on-error", action = "store_true",
+                        help = "drop unprocessed lines unanswered on an error, as Marlin does")
+    parser.add_argument("--report", type = float, default = 0.0,
+                        help = "seconds between unsolicited temperature reports")
+    parser.add_argument("--seed", type = int, default = None)
+    parser.add_argument("--tcp", type = int, default = None, metavar = "PORT",
+                        help = "listen on localhost instead of a pty, 0 for any port")
+    args = parser.parse_args()
+    firmware = FakeFirmware(args.delay, args.latency, args.error_rate,
+                            dict(args.command_delay), args.report, args.seed,
+                            args.flush_on_error)
+    print firmware.open() if args.tcp is None else firmware.open_tcp(args.tcp)
+    sys.stdout.flush()
+    firmware.serve()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Runs the print farm manager against fake firmware endpoints: half of them
+# on ptys, half over TCP on localhost. Reports the farm status as it goes
+# and whether every job got printed.
+#
+#   python testtools/farm_fake.py [--printers N] [--jobs N] [--lines N]
+#                                 [--delay SECONDS]
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.farm import Farm, FarmJob
+from fakefirmware import FakeFirmware
+
+def main():
+    parser = argparse.ArgumentParser(description = "print farm against fake firmware")
+    parser.add_argument("--printers", type = int, default = 4)
+    parser.add_argument("--jobs", type = int, default = 10)
+    parser.add_argument("--lines", type = int, default = 5000)
+    parser.add_argument("--delay", type = float, default = 0.0002,
+                        help = "seconds the firmware takes per line")
+    parser.add_argument("--interval", type = float, default = 1.0)
+    args = parser.parse_args()
+    firmwares = [FakeFirmware(args.delay) for i in xrange(args.printers)]
+    # Forked before the farm starts any threads
+    ports = [firmware.spawn(tcp = bool(i % 2)) for i, firmware in enumerate(firmwares)]
+    farm = Farm()
+    farm.interval = args.interval
+    try:
+        for i, port in enumerate(ports):
+            farm.add_printer("fake%d" % i, port)
+        for i in xrange(args.jobs):
+            lines = ["G1 X%d Y%d E%d" % (n % 200, (n * 7) % 200, n) for n in xrange(args.lines)]
+            farm.submit(FarmJob(gcode = gcoder.GCode(lines), name = "job%d" % i))
+        start = time.time()
+        farm.start()
+        while not farm.wait(args.interval):
+            print farm.format_status()
+            print
+        elapsed = time.time() - start
+        print farm.format_status()
+        jobs = farm.status()["jobs"]
+        print "%d of %d jobs done in %.1fs, %.0f lines/s" % (jobs["done"], args.jobs, elapsed,
+                                                            jobs["done"] * args.lines / elapsed)
+    finally:
+        farm.stop()
+        for firmware in firmwares:
+            firmware.kill()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Prints the job of a recorded session (printcore.start_recording, or
+# pronsole/pronterface --record) again, against a stand-in that plays the
+# printer's side of the recording back, and compares the time the host took
+# with the time it took when it was recorded, the time spent waiting for the
+# printer left out. Runs anywhere, no printer needed.
+#
+#   python testtools/replay.py [--speed FACTOR] [--patience SECONDS]
+#                              [--window BYTES] recording
+#
+# The printer's answers are tied to the lines the host sent before them, so
+# the print has to go out as it did, resends included, over the same kind of
+# connection, a pty or TCP. Recordings say which; for older ones, one with
+# line numbers is served over a pty and one without over TCP. A session over
+# a serial port that printed nothing, everything sent with send_now as a
+# resin job does, is replayed with send_now, each write as it went out.
+# How the lines are grouped into writes and how fast they go may differ. A recording made waiting for every ok replays best with
+# --window 0, one streamed against a receive buffer with the same --window.
+# --speed plays the printer's side that many times faster, 0 for no waiting
+# at all.
+
+import os
+import sys
+import time
+import select
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.printcore import printcore, Ack, MOTION
+from printrun.session import read_session, session_job, session_commands, \
+    session_transport, SENT, RECEIVED, TCP
+from fakefirmware import FakeFirmware
+from bench_printcore import cpu, wait_for
+
+class LineCounter(object):
+    """Counts the lines answers are tied to: the unnumbered ones sent
+    before any numbered line (probes while connecting, and in a session
+    without a print every send_now command) and, from the first numbered
+    line on, the numbered ones, each from 0. Over TCP nothing is numbered,
+    so it is all of them."""
+
+    def __init__(self):
+        self.pending = ""
+        self.probes = 0
+        self.numbered = 0
+
+    def feed(self, data):
+        """Count the whole lines in data, returns whether any counted"""
+        lines = (self.pending + data).split("\n")
+        self.pending = lines.pop()
+        before = self.probes, self.numbered
+        for line in lines:
+            if line.startswith("N"):
+                self.numbered += 1
+            elif not self.numbered:
+                self.probes += 1
+        return (self.probes, self.numbered) != before
+
+def waiting(records):
+    """Seconds of a recording the host spent waiting for the printer, from
+    each line it sent to the answer that came next"""
+    counter = LineCounter()
+    sent = answered = total = 0.0
+    for kind, when, data in records:
+        if kind == SENT:
+            if counter.feed(data):
+                sent = when
+        elif kind == RECEIVED:
+            total += max(0.0, when - max(sent, answered))
+            answered = when
+    return total
+
+class ReplayFirmware(FakeFirmware):
+    """Plays the printer's side of a recording back. Each chunk the printer
+    sent goes out once the host has sent as many lines as it had when the
+    chunk was recorded, counted as LineCounter does, and as long after the
+    last of them as it did in the recording, divided by speed.
+
+    Should the host go quiet for patience seconds short of the lines a
+    chunk waits for, it has gone another way than in the recording; the
+    chunk goes out anyway, and counts as a stall."""
+
+    def __init__(self, records, speed = 1.0, patience = 1.0):
+        FakeFirmware.__init__(self)
+        self.speed = speed
+        self.patience = patience
+        # (probes sent before, numbered lines sent before, seconds after
+        # the last of them, data)
+        self.chunks = []
+        counter = LineCounter()
+        last = 0.0
+        for kind, when, data in records:
+            if kind == SENT:
+                if counter.feed(data):
+                    last = when
+            elif kind == RECEIVED:
+                self.chunks.append((counter.probes, counter.numbered, when - last, data))
+        self.numbered = counter.numbered
+        transport = session_transport(records)
+        # Lines are only numbered over a serial port
+        self.tcp = transport == TCP if transport else not counter.numbered
+        self.played = 0
+        self.stalls = 0
+
+    def serve_stream(self):
+        counter = LineCounter()
+        # When the host had sent each number of probes and numbered lines.
+        # A TCP host is there once connected; over a pty, anything written
+        # before the host opened it is lost, so nothing goes out before it
+        # has been heard from.
+        probes = []
+        numbered = []
+        heard = time.time() if self.listener else None
+        index = 0
+        while True:
+            now = time.time()
+            timeout = None
+            if index < len(self.chunks) and heard is not None:
+                after_probes, after_numbered, delay, data = self.chunks[index]
+                if after_numbered:
+                    reached = numbered[after_numbered - 1] if len(numbered) >= after_numbered else None
+                elif after_probes:
+                    reached = probes[after_probes - 1] if len(probes) >= after_probes else None
+                else:
+                    reached = heard
+                if reached is not None:
+                    due = reached + (delay / self.speed if self.speed else 0.0)
+                elif now - heard >= self.patience:
+                    # The next chunk gets as long again
+                    heard = now
+                    due = now
+                    self.stalls += 1
+                else:
+                    due = heard + self.patience
+                if due <= now:
+                    self.write(data)
+                    index += 1
+                    self.played = index
+                    continue
+                timeout = due - now
+            if select.select([self.master], [], [], timeout)[0]:
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:
+                    return
+                if not data:
+                    return
+                now = time.time()
+                if heard is None:
+                    heard = now
+                self.lines += data.count("\n")
+                if counter.feed(data):
+                    heard = now
+                    probes.extend([now] * (counter.probes - len(probes)))
+                    numbered.extend([now] * (counter.numbered - len(numbered)))
+
+    def stats(self):
+        return {"lines": self.lines,
+                "chunks": len(self.chunks),
+                "played": self.played,
+                "stalls": self.stalls}
+
+def main():
+    parser = argparse.ArgumentParser(description = "Replay a recorded printer session against printcore")
+    parser.add_argument("--speed", type = float, default = 1.0,
+                        help = "play the printer's side this many times faster, 0 for no waiting")
+    parser.add_argument("--patience", type = float, default = 1.0,
+                        help = "seconds to wait for lines the host may never send")
+    parser.add_argument("--window", type = int, default = 0,
+                        help = "firmware receive buffer to stream against, in bytes")
+    parser.add_argument("recording")
+    args = parser.parse_args()
+    records = list(read_session(args.recording))
+    if not records:
+        print "Nothing recorded in %s" % args.recording
+        return
+    firmware = ReplayFirmware(records, args.speed, args.patience)
+    if firmware.tcp or firmware.numbered:
+        job = session_job(records)
+        writes = None
+    else:
+        writes = session_commands(records)
+        job = sum(writes, [])
+    port = firmware.spawn(tcp = firmware.tcp)
+    p = printcore()
+    p.window = args.window
+    # The replay is recorded as well, so both are timed the same way
+    fd, replay_path = tempfile.mkstemp(suffix = ".session")
+    os.close(fd)
+    try:
+        p.start_recording(replay_path)
+        used = cpu()
+        p.connect(port, 115200)
+        if not wait_for(lambda: p.online, 10 + args.patience):
+            print "The replay never came online"
+            return
+        if firmware.tcp or firmware.numbered:
+            p.startprint(gcoder.GCode(job))
+            wait_for(lambda: not p.printing, 3600)
+        else:
+            # Each write once the one before is answered, in the order it
+            # was sent, whatever priority send_now would give its commands
+            for commands in writes:
+                ack = Ack()
+                p.send_now_many(commands[:-1] + [(commands[-1], ack)], MOTION)
+                if not ack.wait(10 + args.patience):
+                    print "No answer to %s, giving up" % commands[-1]
+                    break
+        used = cpu() - used
+        p.stop_recording()
+        replayed = list(read_session(replay_path))
+    finally:
+        p.disconnect()
+        stats = firmware.kill()
+        os.remove(replay_path)
+    print "%d lines, %d of %d answers played back, %d stalls" % (
+        len(job), stats["played"], stats["chunks"], stats["stalls"])
+    # What is left once the waiting for the printer is taken out is the
+    # time the host took
+    host = []
+    for name, session in (("recorded", records), ("replayed", replayed)):
+        elapsed = session[-1][1] - session[0][1]
+        waited = waiting(session)
+        host.append(elapsed - waited)
+        print "%s: %.2fs, %.2fs of it waiting for the printer, %.2fs host" % (
+            name, elapsed, waited, elapsed - waited)
+    print "host %.2fx the recording at speed %g, %.0f lines/s, %.1f us CPU/line" % (
+        host[1] / host[0] if host[0] > 0 else 0.0, args.speed,
+        len(job) / (replayed[-1][1] - replayed[0][1]), 1e6 * used / max(1, len(job)))
+
+if __name__ == "__main__":
+    main()